@@ -2,9 +2,9 @@
 
 class UnknownPaxosMessageType(Exception): pass
 
-from collections import Counter
 import time
 from debug import debug
+import codec
 
 # Implement Paxos.
 
@@ -57,6 +57,8 @@ class Num(object):
     def __add__(self,n):
         return Num(self.c + n, self.id)
 
+codec.register(Num,1,lambda x: (x.c,x.id),Num)
+
 
 # A Proposal is just a Num and a proposed value. 
 # We define a total ordering on the Proposal for ease of 
@@ -83,29 +85,40 @@ class Proposal(object):
     def __hash__(self):
         return hash((self.n,self.v))
 
+codec.register(Proposal,2,lambda x: (x.n,x.v),Proposal)
+
 
 #############################################################
 
 class PaxosNode(object):
-    """docstring for PaxosNode"""
-    def __init__(self, nodeid, otherAddrs, sendfn):
+    """
+    Paxos on a single value. Plays proposer, acceptor and learner.
+    'pid' is what goes in this node's proposal Nums (default: nodeid); nodes whose
+    Nums get compared with each other need pids of the same kind.
+    'on_decide', if given, is called with the value once this node learns it.
+    """
+    def __init__(self, nodeid, otherAddrs, sendfn, pid=None, on_decide=None):
         self.send = sendfn
+        self.on_decide = on_decide
 
         # Proposer
         self.vdefault = None 
         self.id = nodeid
+        self.pid = pid if pid is not None else nodeid
         self.P_acceptors = [self.id] + otherAddrs
         # must rx > this many responses to my 'prepare reqs' from A's to have buy-in from majority of A's:
         self.MAJORITY = (0+len(self.P_acceptors))/2.0  # (of acceptors) WARNING: assumes self is already in the list of acceptors        
         self.prepare_responses = {}
+        self.accept_requested = set()  # ns I've already sent accept requests for
 
         # Acceptor
         self.highest_accepted_proposal = None  # Warning: This must be None, not Proposal(); need to remember if an acceptor hasn't heard any proposals yet.
-        self.highest_responded_prepreq = Num(ctr=0,pid=self.id)
+        self.highest_responded_prepreq = Num(ctr=0,pid=self.pid)
         self.A_learners = [self.id] + otherAddrs 
 
         # Learner
-        self.L_accepted_values = {}
+        self.L_accepted = {}  # acceptor -> Num of the latest proposal it told us it accepted
+        self.L_votes = {}     # Num -> how many acceptors' latest accepted proposal that is
         self.v = None
 
 
@@ -147,7 +160,8 @@ class PaxosNode(object):
 
 
         # Increment my existing highest Num. Dedicate myself to promoting the new value.
-        n = self.highest_responded_prepreq + 1
+        # (With my own pid, not whoever's Num that was, so no one else can pick the same n.)
+        n = Num(self.highest_responded_prepreq.c + 1, self.pid)
         self.prepare_responses[n] = {}  # I may have multiple prepare-requests in the air, 
                                         # each with different n. Group their responses by n.
 
@@ -179,6 +193,11 @@ class PaxosNode(object):
         n = d['n'] 
         if n not in self.prepare_responses:
             print("!!!!!!!!!P{}: Shouldn't happen: Somehow I rxd a repsonse to a prepare-request with an n I didn't send: {}".format(self.id,d))
+            return
+        if n in self.accept_requested:
+            # Already picked v for this n and sent accept requests. A late response must not
+            # make us send a second, different value with the same n.
+            return
 
         self.prepare_responses[n][d['from']] = d  # for this n, remember who voted for what.
 
@@ -198,6 +217,7 @@ class PaxosNode(object):
                 v = self.vdefault
 
             p = Proposal(n,v)
+            self.accept_requested.add(n)
 
             for to in self.prepare_responses[n].keys():  # to each Acceptor I've heard from
                 debug('P{}: txing accept req to A={} with proposal={}'.format(self.id,to,p))
@@ -214,6 +234,27 @@ class PaxosNode(object):
                     self.send(r)
 
 
+    def P_accept(self,n,v):
+
+        # Phase 2a without Phase 1, for a Multi-Paxos leader that already holds
+        # promises for n from a majority of acceptors (see MultiPaxosNode).
+        # Ask every acceptor to accept proposal (n,v).
+
+        p = Proposal(n,v)
+        for to in self.P_acceptors:
+            debug('P{}: txing leader accept req to A={} with proposal={}'.format(self.id,to,p))
+            r = {
+                'from': self.id,
+                'to': to,
+                'type': 'accept request',
+                'p': p
+                }
+            if to == self.id:
+                self.A_rx_accept_request(r)
+            else:
+                self.send(r)
+
+
     ###########################################
     # Acceptor methods:
 
@@ -263,6 +304,10 @@ class PaxosNode(object):
         if self.highest_responded_prepreq <= d['p'].n:
             debug('A{}: Accepting!'.format(self.id))
             self.highest_accepted_proposal = d['p'] # accept the proposal
+            # Accepting n also means we won't go back to anything below n. Without this, an acceptor
+            # outside a Multi-Paxos leader's Phase 1 majority could take a stale, lower-numbered
+            # accept request after this one and forget what it accepted.
+            self.highest_responded_prepreq = d['p'].n
 
             # Phase 3. (Learning a Chosen Value) To learn that a value has been chosen, 
             # a learner must find out that a proposal has been accepted by
@@ -310,24 +355,385 @@ class PaxosNode(object):
 
         debug('L{}: Acceptor{} decided proposal p={}'.format(self.id,d['from'],d['p']))
 
-        self.L_accepted_values[d['from']] = d['p'].v
+        if self.v is not None: return  # already learned it, nothing more to count
 
-        debug('BTW, heres L_accepted_values:')
-        for k,v in self.L_accepted_values.items():
-            debug('from:',k,'logvalue:',v)
+        # Count acceptances per proposal Num, not per value: one Num only ever carries one value,
+        # and comparing Nums is cheap however big the value is. (Counting equal values across
+        # different Nums was also wrong: it could add up votes for proposals that were never chosen.)
+        # An acceptor's vote moves to each higher-numbered proposal it accepts.
+        p = d['p']
+        old = self.L_accepted.get(d['from'])
+        if old is not None:
+            if not old < p.n: return  # a stale or repeated msg
+            self.L_votes[old] -= 1
+        self.L_accepted[d['from']] = p.n
+        c = self.L_votes[p.n] = self.L_votes.get(p.n,0) + 1
 
-        # If a majority of Acceptors agree, set our value.
+        # If a majority of Acceptors accepted proposal p, its value was chosen.
 
-        if len(self.L_accepted_values) == 0: return
-
-        v,c = Counter(self.L_accepted_values.values()).most_common(1)[0]
         if c > self.MAJORITY:
-            debug('L{}: majority of As accepted val={}!'.format(self.id,v))
-            self.v = v
+            debug('L{}: majority of As accepted p={}!'.format(self.id,p))
+            self.v = p.v
+            self.L_accepted,self.L_votes = {},{}  # won't need them again
+            if p.v is not None and self.on_decide is not None: self.on_decide(p.v)
         else:
-            debug("L{}: Most common val={} appears {} times < MAJORITY={}. Learner can't accept yet.".format(
-                self.id,v,c,self.MAJORITY) )
+            debug("L{}: p={} accepted by {} As, not more than MAJORITY={}. Learner can't accept yet.".format(
+                self.id,p,c,self.MAJORITY) )
+
+
+
+#############################################################
+
+# Multi-Paxos.
+#
+# A MultiPaxosNode owns a log of PaxosNodes, one per slot, and can run them two ways:
+#
+# Classic (leader=False): every value gets its own full Paxos instance in the first
+# undecided slot: a prepare round, then an accept round.
+#
+# Stable leader (leader=True): the proposer runs Phase 1 once, with a 'multi prepare'
+# for Num n that covers every slot from the first one it hasn't seen decided onward.
+# Each acceptor promises n for all of those slots at once (and for any slot it hears
+# about later), and reports what it has already accepted there. Once a majority has
+# promised, this node is the leader: it re-proposes whatever was already accepted in
+# those slots, and from then on each new value needs only Phase 2, an accept round
+# with n. If another proposer takes over (we promise a higher Num, or our values stop
+# getting chosen and retry() is called), we run Phase 1 again with a higher n.
+#
+# A leader keeps up to 'window' of its own values in flight at once, each in its own
+# slot, and queues the rest until one of them is decided. A value can be anything
+# hashable, e.g. a tuple of several things to be logged together.
+#
+# The log has no fixed size. A slot's PaxosNode is only created when someone first
+# proposes in it or sends it a message, and it is thrown away as soon as the slot is
+# decided: from then on all we keep is the chosen value. A proposer that reaches a
+# slot we've already freed gets a 'chosen' message back with the value instead.
+#
+# Read leases (lease > 0, stable leader only): the leader can ask the acceptors for a
+# lease on its ballot with request_lease(). An acceptor that has promised exactly that
+# ballot grants it, and then for 'lease' secs defers any multi prepare from another
+# proposer instead of promising it. Once a majority has granted a lease, no one else
+# can become leader, and so no one else can get a value chosen, until it runs out. So
+# while has_lease(), the leader knows every value that has been chosen is either in
+# its log or among its own in-flight accept requests: once everything below
+# read_index() is decided, its log is up to date, without a consensus round.
+# The leader counts its lease from when it asked, and only for 9/10 of 'lease', so
+# it runs out before any acceptor's does even if the clocks run a little apart.
+# An acceptor with a deferred prepare grants no more leases until it has answered it,
+# so a leader that keeps renewing can't shut out everyone else for good.
+# Whoever drives the node should call tick() now and then to answer deferred prepares.
+#
+# Like PaxosNode, there is no networking here. Per-slot messages go out through
+# sendfn as {'to': addr, 'elem': slot, 'msg': d}, where d is the PaxosNode's message;
+# the other messages go out as {'to': addr, 'from': my addr, 'type': ...}.
+# Hand whatever arrives to rx().
+
+class MultiPaxosNode(object):
+    def __init__(self, nodeid, otherAddrs, sendfn, leader=True, window=1, lease=0, clock=time.monotonic):
+        self.id = nodeid
+        self.others = otherAddrs
+        self.send = sendfn
+        self.leader = leader
+        self.window = window
+        self.lease = lease if leader else 0
+        self.clock = clock
+        self.MAJORITY = (1+len(otherAddrs))/2.0
+
+        self.values = []        # the log: slot -> chosen value, or None while undecided
+        self.first_unchosen = 0 # every slot below this one is decided
+        self.slots = {}         # slot -> PaxosNode, for undecided slots we've touched
+        self.dirty = set()      # slots whose state may have changed; whoever persists it clears this
+
+        # Acceptor: the highest Num I've promised to in a multi prepare.
+        # It covers every slot from the prepare's 'first' onward, including ones I create later.
+        self.promised = Num(ctr=0,pid=self.id)
+        self.granted = None      # Num I've granted a read lease to, if any
+        self.granted_until = 0   # ... and until when (by self.clock)
+        self.deferred = None     # the highest multi prepare I'm holding back because of that lease
+
+        # Leader
+        self.ballot = None     # Num that a majority has promised me, if I'm the leader
+        self.preparing = None  # Num of my outstanding multi prepare, if any
+        self.first = 0         # ... and the first slot it covers
+        self.promises = {}     # acceptor -> its 'multi promise' for self.preparing
+        self.inflight = {}     # slot -> my value I've sent accept requests for
+        self.recovered = set() # slots where I'm re-proposing a value found in Phase 1
+        self.pending = []      # values waiting for a slot
+        self.next = 0          # where I look for the next free slot
+        self.lease_until = 0   # my read lease on self.ballot lasts until then (by self.clock)
+        self.lease_round = 0   # which lease request the grants coming in are for
+        self.lease_n = None    # ... the ballot it was for
+        self.lease_asked = 0   # ... when I sent it
+        self.grants = set()    # ... and who has granted it
+
+    def slot(self,i):
+        # The PaxosNode for undecided slot i, made on first use.
+        # Per-slot nodeids are (addr,slot) as before, but Nums carry just the addr,
+        # so a multi prepare's Num compares cleanly with every slot's.
+        self.dirty.add(i)  # whoever asks for a slot may be about to change it
+        p = self.slots.get(i)
+        if p is None:
+            p = PaxosNode(nodeid=(self.id,i),
+                          otherAddrs=[(o,i) for o in self.others],
+                          sendfn=lambda d,i=i: self.send({'to':d['to'][0],'elem':i,'msg':d}),
+                          pid=self.id,
+                          on_decide=lambda v,i=i: self.decided(i,v))
+            if self.promised > p.highest_responded_prepreq:
+                p.highest_responded_prepreq = self.promised
+            self.slots[i] = p
+        return p
 
+    def __str__(self):
+        return '<MultiPaxosNode id={} leader={} ballot={} first_unchosen={} inflight={} pending={}>'.format(
+            self.id, self.leader, self.ballot, self.first_unchosen, sorted(self.inflight), len(self.pending))
+
+    def log(self):
+        return self.values
+
+    def chosen(self,i):
+        # The value chosen in slot i, or None.
+        return self.values[i] if i < len(self.values) else None
+
+    def first_undecided(self):
+        return self.first_unchosen
+
+    def is_leader(self):
+        # Still leader unless I've since promised someone else a higher Num.
+        return self.ballot is not None and not self.promised > self.ballot
+
+    def rx(self,d):
+        if 'elem' in d:
+            i = d['elem']
+            v = self.chosen(i)
+            if v is None:
+                self.slot(i).rx(d['msg'])
+            elif d['msg']['type'] in ('prepare request','accept request'):
+                # That slot is decided and its Paxos state is gone. Tell the proposer what won.
+                self.tx({'from':self.id, 'to':d['msg']['from'][0], 'type':'chosen', 'slot':i, 'v':v})
+            return
+        t = d['type']
+        if t == 'multi prepare':
+            self.A_rx_multi_prepare(d)
+        elif t == 'multi promise':
+            self.P_rx_multi_promise(d)
+        elif t == 'multi nack':
+            self.P_rx_multi_nack(d)
+        elif t == 'chosen':
+            self.decided(d['slot'],d['v'])
+        elif t == 'lease request':
+            self.A_rx_lease_request(d)
+        elif t == 'lease grant':
+            self.P_rx_lease_grant(d)
+        else:
+            raise UnknownPaxosMessageType(d)
+
+    def tx(self,d):
+        if d['to'] == self.id:
+            self.rx(d)
+        else:
+            self.send(d)
+
+    ###########################################
+    # Proposer / leader
+
+    def propose(self,v):
+        # Try to get v into the log. Returns right away; decided() hears where it lands.
+        if not self.leader:
+            self.slot(self.first_unchosen).initiate_paxos(v)
+            return
+        if v is not None: self.pending.append(v)
+        if self.is_leader():
+            self.flush()
+        elif self.preparing is None:
+            self.prepare()
+
+    def retry(self):
+        # Our values aren't getting chosen. Maybe someone else took over: start Phase 1 over.
+        if not self.leader:
+            return
+        self.ballot = None
+        self.prepare()
+
+    def has_lease(self):
+        return self.is_leader() and self.clock() < self.lease_until
+
+    def request_lease(self):
+        # Ask the acceptors for a (new) read lease on my ballot, see has_lease().
+        if not self.lease or not self.is_leader(): return
+        self.lease_round += 1
+        self.lease_n = self.ballot
+        self.lease_asked = self.clock()
+        self.grants = set()
+        for to in [self.id] + self.others:
+            self.tx({'from':self.id, 'to':to, 'type':'lease request', 'n':self.ballot, 'round':self.lease_round})
+
+    def P_rx_lease_grant(self,d):
+        if d['round'] != self.lease_round or d['n'] != self.ballot:
+            return  # an old request
+        self.grants.add(d['from'])
+        if len(self.grants) > self.MAJORITY:
+            self.lease_until = self.lease_asked + 0.9*self.lease
+
+    def read_index(self):
+        # Once every slot below this is decided, my log has everything chosen up to now.
+        # (Only if has_lease(): otherwise someone else may be getting values chosen.)
+        return max([self.first_unchosen] + [i+1 for i in self.inflight] + [i+1 for i in self.recovered])
+
+    def withdraw(self,v):
+        # Stop trying to place v (if it's still waiting for a slot).
+        self.pending = [x for x in self.pending if x is not v]
+
+    def prepare(self):
+        self.ballot = None
+        c = max([self.promised.c] + [p.highest_responded_prepreq.c for p in self.slots.values()])
+        n = Num(c+1,self.id)
+        self.preparing = n
+        self.first = self.first_unchosen
+        self.promises = {}
+        debug('MP{}: multi prepare n={} for slots {}+'.format(self.id,n,self.first))
+        for to in [self.id] + self.others:
+            self.tx({'from':self.id, 'to':to, 'type':'multi prepare', 'n':n, 'first':self.first})
+
+    def P_rx_multi_promise(self,d):
+        if d['n'] != self.preparing:
+            return  # an old round
+        self.promises[d['from']] = d
+        if len(self.promises) <= self.MAJORITY:
+            return
+        n = self.preparing
+        debug('MP{}: majority promised n={}, I am leader'.format(self.id,n))
+        self.preparing = None
+
+        # What did the acceptors already accept (or know was chosen) in my slots?
+        # For each slot, the value of the highest-numbered accepted proposal has to be
+        # proposed again, just like in Phase 2a of single-decree Paxos.
+        chosen = {}
+        best = {}
+        for r in self.promises.values():
+            chosen.update(r['chosen'])
+            for i,p in r['accepted'].items():
+                if p.v is not None and (i not in best or p > best[i]): best[i] = p
+        # Reserve the recovered slots before anything gets a chance to flush() into them.
+        # (self.ballot is still None here, so decided() won't flush either.)
+        self.recovered = set()
+        for i in best:
+            if i not in chosen and self.chosen(i) is None:
+                self.recovered.add(i)
+        for i,v in chosen.items():
+            self.decided(i,v)
+        taken = set(chosen) | set(best)
+        for i,v in list(self.inflight.items()):
+            w = chosen[i] if i in chosen else best[i].v if i in best else v
+            if w != v:
+                del self.inflight[i]
+                self.pending.insert(0,v)  # lost that slot to someone else's value
+
+        self.ballot = n
+        for i in sorted(self.recovered):
+            self.accept(i,best[i].v)
+        for i,v in list(self.inflight.items()):
+            if i not in taken: self.accept(i,v)
+        self.next = self.first
+        self.flush()
+
+    def P_rx_multi_nack(self,d):
+        # Someone has a higher Num. Remember it, so our next try outbids it.
+        debug('MP{}: multi prepare n={} refused by {}, who promised {}'.format(self.id,d['n'],d['from'],d['promised']))
+        if d['promised'] > self.promised: self.promised = d['promised']
+
+    def flush(self):
+        # Put pending values into free slots with accept requests, up to 'window' at a time.
+        while self.pending and len(self.inflight) < self.window:
+            i = self.free_slot()
+            v = self.pending.pop(0)
+            self.inflight[i] = v
+            self.accept(i,v)
+
+    def free_slot(self):
+        # The log never fills up; the next free slot is at most a few past the end.
+        self.next = max(self.next,self.first_unchosen)
+        while self.chosen(self.next) is not None or self.next in self.inflight or self.next in self.recovered:
+            self.next += 1
+        return self.next
+
+    def accept(self,i,v):
+        debug('MP{}: leader n={} proposing v={} in slot {}'.format(self.id,self.ballot,v,i))
+        self.slot(i).P_accept(self.ballot,v)
+
+    def decided(self,i,v):
+        if self.chosen(i) is not None:
+            return
+        # Remember the value and drop the slot's Paxos state; rx() answers for it from now on.
+        if i >= len(self.values):
+            self.values.extend([None]*(i+1-len(self.values)))
+        self.values[i] = v
+        self.slots.pop(i,None)
+        self.dirty.add(i)
+        while self.first_unchosen < len(self.values) and self.values[self.first_unchosen] is not None:
+            self.first_unchosen += 1
+
+        self.recovered.discard(i)
+        mine = self.inflight.pop(i,None)
+        if mine is not None and mine != v:
+            # Someone else's value got slot i. Ours needs another one.
+            self.pending.insert(0,mine)
+        if mine is not None and self.is_leader(): self.flush()  # room in the window now
+
+    ###########################################
+    # Acceptor
+
+    def A_rx_multi_prepare(self,d):
+        n,first = d['n'],d['first']
+        if self.leased_to_other(n):
+            # Answer once the lease I granted runs out (see tick()).
+            if self.deferred is None or n > self.deferred['n']: self.deferred = d
+            return
+        slots = [(i,p) for i,p in self.slots.items() if i >= first]
+        highest = max([self.promised] + [p.highest_responded_prepreq for i,p in slots])
+        if n > highest:
+            self.promised = n
+            for i,p in slots:
+                p.highest_responded_prepreq = n
+                self.dirty.add(i)
+            r = {
+                'from': self.id,
+                'to': d['from'],
+                'type': 'multi promise',
+                'n': n,
+                'accepted': {i:p.highest_accepted_proposal for i,p in slots if p.highest_accepted_proposal is not None},
+                'chosen': {i:self.values[i] for i in range(first,len(self.values)) if self.values[i] is not None},
+                }
+        else:
+            r = {'from':self.id, 'to':d['from'], 'type':'multi nack', 'n':n, 'promised':highest}
+        self.tx(r)
+
+    def leased_to_other(self,n):
+        return self.granted is not None and self.clock() < self.granted_until and n.id != self.granted.id
+
+    def A_rx_lease_request(self,d):
+        # Grant a lease only on the ballot I've promised, and not while someone else is waiting.
+        if d['n'] != self.promised or self.deferred is not None:
+            return
+        self.granted = d['n']
+        self.granted_until = self.clock() + self.lease
+        self.tx({'from':self.id, 'to':d['from'], 'type':'lease grant', 'n':d['n'], 'round':d['round']})
+
+    def restarted(self):
+        # Call after restoring acceptor state from disk: a lease I granted before I went
+        # down may still be running, so act as if I'd just granted it again.
+        if self.lease:
+            self.granted = self.promised
+            self.granted_until = self.clock() + self.lease
+
+    def tick(self):
+        # Answer a deferred multi prepare once the lease is over.
+        if self.deferred is not None and not self.leased_to_other(self.deferred['n']):
+            d,self.deferred = self.deferred,None
+            self.A_rx_multi_prepare(d)
+
+    def next_tick(self):
+        # When tick() will have something to do (by self.clock), or None.
+        return self.granted_until if self.deferred is not None else None
 
 
 def main():
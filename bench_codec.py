@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark: how big are our messages, and how long do they take to
+# encode and decode, with plain pickle vs. codec.py (with and without compression)?
+#
+#   ./bench_codec.py [reduced_file]     (default data/PPc.txt_reduced)
+
+import sys, json, pickle, timeit
+import codec
+from PaxosNode import Num, Proposal
+from paxosreplicator import LogValue, Digest
+
+
+def messages(f):
+    me = (('127.0.0.1',5004),0)
+    other = (('127.0.0.1',5009),0)
+    n = Num(7,me)
+    v = LogValue(filename=f,wordcounts=json.load(open(f,'r')))
+    x = Digest(bytes(32),len(codec.dumps(v,compress=False)))  # what the PRM actually sends now
+    wrap = lambda d: {'paxos':True,'elem':0,'msg':d}
+    return [
+        ('cli total',        {'cmd':'total','logpositions':[0,1,2]}),
+        ('prepare request',  wrap({'from':me,'to':other,'type':'prepare request','n':n})),
+        ('prepare response', wrap({'from':other,'to':me,'type':'prepare response','p':None,'n':n})),
+        ('accept request',   wrap({'from':me,'to':other,'type':'accept request','p':Proposal(n,v)})),
+        ('decision',         wrap({'from':other,'to':me,'type':'decision','p':Proposal(n,v)})),
+        ('accept (digest)',  wrap({'from':me,'to':other,'type':'accept request','p':Proposal(n,x)})),
+        ('payload',          {'bulk':'blob','from':me[0],'sha':x.sha,'data':codec.dumps(v,compress=False)}),
+    ]
+
+
+def bench(fn,arg):
+    # Best-of-5 time per call, in microseconds.
+    t = timeit.Timer(lambda: fn(arg))
+    n,_ = t.autorange()
+    return min(t.repeat(5,n))/n*1e6
+
+
+def main():
+    f = sys.argv[1] if len(sys.argv)>1 else 'data/PPc.txt_reduced'
+    codecs = [
+        ('pickle',       pickle.dumps,                         pickle.loads),
+        ('codec',        lambda x: codec.dumps(x,compress=False), codec.loads),
+        ('codec+zip',    codec.dumps,                          codec.loads),
+    ]
+    print('{:<18} {:<10} {:>10} {:>12} {:>12}'.format('message','codec','bytes','encode us','decode us'))
+    for name,msg in messages(f):
+        for cname,dumps,loads in codecs:
+            b = dumps(msg)
+            print('{:<18} {:<10} {:>10} {:>12.1f} {:>12.1f}'.format(name,cname,len(b),bench(dumps,msg),bench(loads,b)))
+        print('')
+    print('(compressing with {})'.format('lz4' if codec.lz4 is not None else 'zlib'))
+
+
+if __name__ == '__main__':
+    main()
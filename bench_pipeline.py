@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmark: start the mappers, reducers and 3 PRMs on localhost, and for
+# each input file do what you'd type at the CLI, i.e.
+#
+#   map F     reduce F_I_1 F_I_2 ...     replicate F_reduced
+#
+# timing each phase. The inputs are data/PPa.txt, PPb.txt and PPc.txt, plus synthetic
+# text of the sizes in 'synthetic' (e.g. --synthetic=100M,1G), made of the words of the
+# PP*.txt files at the frequencies they have there. For each input and phase we report
+#
+#   secs    wall time, from sending the first msg to the last reply ('Good news' for replicate)
+#   in/out  bytes of files the phase read and wrote (input, intermediate and reduced files)
+#   io      bytes the phase's processes read and wrote, files and sockets, from /proc/PID/io
+#   rss     the biggest peak RSS of the phase's processes, from /proc/PID/status
+#
+# (io and rss are only there on Linux, and don't count a mapper's pool processes, see
+# --procs.) At the end we add the peak RSS of any child process and of the benchmark
+# itself, from resource.getrusage().
+#
+#   ./bench_pipeline.py [--option=value ...]     e.g. ./bench_pipeline.py --synthetic=1G --combine=1
+#
+# Options (and defaults) are in OPTIONS below; combine, format, compress, procs and
+# memory go to the mappers/reducers as the CLI's 'set' would. Without --combine a mapper
+# holds every word of its split in memory, so for GB inputs you want --combine=1.
+# --json prints the results as JSON, with the git commit, to compare between commits.
+
+import sys, os, time, json, random, queue, threading, tempfile, subprocess, resource, contextlib
+from collections import Counter
+import network
+import mapper
+import cli
+
+OPTIONS = {
+    'inputs':    'data/PPa.txt,data/PPb.txt,data/PPc.txt',
+    'synthetic': '16M',       # sizes of synthetic inputs, with K/M/G; '' for none
+    'mappers':   2,
+    'reducers':  1,
+    'combine':   False,       # these five as in the CLI's opts
+    'format':    'bin',
+    'compress':  False,
+    'procs':     1,
+    'memory':    0,
+    'prm':       '',          # flags for the PRMs, e.g. '--window=8 --batch=8'
+    'durable':   False,       # give the PRMs a --state-dir each, so the log is fsynced
+    'dir':       '',          # where to put the files; '' for a temp dir. Synthetic inputs found here are reused
+    'port':      7400,        # first of the ports to listen on
+    'timeout':   600.0,       # secs to wait for a replicate before giving up
+    'seed':      1,
+    }
+
+HOST = '127.0.0.1'
+BLOCK = 1<<20  # synthetic text is written a block at a time, picked from a few random ones
+BLOCKS = 16
+
+
+def size(s):
+    # '16M' -> 16777216
+    mult = {'K':1<<10,'M':1<<20,'G':1<<30}
+    return int(float(s[:-1])*mult[s[-1].upper()]) if s[-1].upper() in mult else int(s)
+
+
+def synthesize(path,n,corpus,rng):
+    # n bytes of words from the files in 'corpus', at the frequencies they have there.
+    c = Counter()
+    for f in corpus:
+        c.update(w.decode('utf-8',errors='replace') for w in open(f,'rb').read().split())
+    words,weights = list(c),list(c.values())
+    avg = sum(len(w.encode('utf-8'))*k for w,k in c.items())/sum(weights) + 1
+    blocks = []
+    for _ in range(BLOCKS):
+        ws = rng.choices(words,weights,k=int(BLOCK/avg))
+        blocks.append('\n'.join(' '.join(ws[i:i+12]) for i in range(0,len(ws),12)).encode('utf-8') + b'\n')
+    with open(path+'.tmp','wb') as fd:
+        left = n
+        while left > 0:
+            b = rng.choice(blocks)
+            if len(b) > left: b = b[:b.rfind(b' ',0,left)+1 or left]  # don't cut the last word in half
+            fd.write(b)
+            left -= len(b)
+    os.replace(path+'.tmp',path)
+
+
+###########################################
+# What /proc says about a process (None where there's no /proc)
+
+def proc_io(pid):
+    try:
+        d = dict(l.split(':') for l in open('/proc/{}/io'.format(pid)))
+        return int(d['rchar']) + int(d['wchar'])
+    except (OSError,KeyError,ValueError):
+        return None
+
+def peak_rss(pid):
+    try:
+        for l in open('/proc/{}/status'.format(pid)):
+            if l.startswith('VmHWM:'): return int(l.split()[1])*1024
+    except (OSError,ValueError):
+        pass
+    return None
+
+def reset_peak_rss(pid):
+    # So peak_rss() covers just the next phase (Linux 4.0+).
+    try:
+        with open('/proc/{}/clear_refs'.format(pid),'w') as fd: fd.write('5')
+    except OSError:
+        pass
+
+
+class Phase(object):
+    """
+    Measures one phase over processes 'procs': with Phase(...) as ph: ...; then ph.result().
+    """
+    def __init__(self,name,procs):
+        self.name,self.procs = name,procs
+
+    def __enter__(self):
+        for p in self.procs: reset_peak_rss(p.pid)
+        self.io = [proc_io(p.pid) for p in self.procs]
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self,*exc):
+        self.secs = time.time() - self.t0
+
+    def result(self,bytes_in,bytes_out):
+        io = [proc_io(p.pid) for p in self.procs]
+        rss = [peak_rss(p.pid) for p in self.procs]
+        return {
+            'phase': self.name,
+            'secs': self.secs,
+            'in': bytes_in,
+            'out': bytes_out,
+            'io': sum(b-a for a,b in zip(self.io,io)) if None not in self.io+io else None,
+            'rss': max(rss) if None not in rss else None,
+            }
+
+
+###########################################
+
+class Cluster(object):
+    """
+    The mappers, reducers and PRMs, each its own process as in run-locally.sh.
+    """
+    def __init__(self,o,workdir):
+        here = os.path.dirname(os.path.abspath(__file__))
+        port = o['port']
+        def addrs(n):
+            nonlocal port
+            port += n
+            return [(HOST,p) for p in range(port-n,port)]
+        self.map_addrs,self.red_addrs,self.prm_addrs = addrs(o['mappers']),addrs(o['reducers']),addrs(3)
+        py = [sys.executable,'-u']
+        self.mappers = [subprocess.Popen(py+[os.path.join(here,'mapper.py'),str(i+1),h,str(p)],stdout=subprocess.DEVNULL)
+                        for i,(h,p) in enumerate(self.map_addrs)]
+        self.reducers = [subprocess.Popen(py+[os.path.join(here,'reducer.py'),h,str(p)],stdout=subprocess.DEVNULL)
+                         for h,p in self.red_addrs]
+        self.prms = []
+        for j,(h,p) in enumerate(self.prm_addrs):
+            args = py + [os.path.join(here,'paxosreplicator.py')] + o['prm'].split()
+            if o['durable']: args.append('--state-dir={}'.format(os.path.join(workdir,'prm{}'.format(j))))
+            args += [h,str(p)]
+            for other in self.prm_addrs[:j]+self.prm_addrs[j+1:]: args += [other[0],str(other[1])]
+            out = subprocess.PIPE if j == 0 else subprocess.DEVNULL
+            self.prms.append(subprocess.Popen(args,stdout=out,stderr=subprocess.STDOUT,universal_newlines=True))
+        # The first PRM's output tells us when a replicate is done; read it all, so it never blocks on a full pipe.
+        self.lines = queue.Queue()
+        threading.Thread(target=lambda: [self.lines.put(l) for l in self.prms[0].stdout],daemon=True).start()
+        time.sleep(1)  # let them start listening
+
+    def kill(self):
+        for addr in self.map_addrs + self.red_addrs + self.prm_addrs:
+            network.send(addr,{'cmd':'k'})
+        for p in self.mappers + self.reducers + self.prms:
+            try:
+                p.wait(timeout=network.DEADLINE)
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+
+
+def wait_all(sends):
+    # Send each (addr,msg) and wait for all the replies, like cli.shuffle_reduce().
+    threads = [threading.Thread(target=network.send,args=[addr,d,lambda b: None]) for addr,d in sends]
+    for t in threads: t.start()
+    for t in threads: t.join()
+
+
+def files_size(fs):
+    return sum(os.path.getsize(f) for f in fs)
+
+
+def run(c,f,o):
+    # Map, reduce and replicate input f on cluster c; returns the phases' results.
+    opts = {k:o[k] for k in ('combine','format','compress','procs','memory')}
+    def task(**kw):
+        kw.update(opts)
+        kw['partitions'] = len(c.red_addrs)
+        return kw
+    R = len(c.red_addrs)
+    results = []
+
+    with Phase('map',c.mappers) as ph:
+        wait_all([(addr,task(filename=f,offset=offset,size=n))
+                  for addr,(offset,n) in zip(c.map_addrs,mapper.split(f,len(c.map_addrs)))])
+    inter = ['{}_I_{}'.format(f,i+1) for i in range(len(c.map_addrs))]
+    parts = inter if R == 1 else ['{}_{}'.format(g,p) for g in inter for p in range(R)]
+    results.append(ph.result(os.path.getsize(f),files_size(parts)))
+
+    reduced = f + '_reduced'
+    with Phase('reduce',c.reducers) as ph:
+        if R == 1:
+            wait_all([(c.red_addrs[0],task(filenames=inter))])
+        else:
+            cli.shuffle_reduce(c.red_addrs,inter,task)
+    results.append(ph.result(files_size(parts),os.path.getsize(reduced)))
+
+    with Phase('replicate',c.prms) as ph:
+        network.send(c.prm_addrs[0],{'cmd':'replicate','filename':reduced})
+        deadline = time.time() + o['timeout']
+        ok = None
+        while ok is None:
+            try:
+                line = c.lines.get(timeout=max(0,deadline-time.time()))
+            except queue.Empty:
+                ok = False
+                break
+            if line.startswith('Good news'): ok = True
+            elif line.startswith('Sorry'): ok = False
+    r = ph.result(os.path.getsize(reduced),None)
+    r['ok'] = ok
+    results.append(r)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL,universal_newlines=True).strip()
+    except (OSError,subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    o = dict(OPTIONS)
+    for a in sys.argv[1:]:
+        k,_,v = a[2:].partition('=')
+        if k == 'json': continue
+        if k not in o: sys.exit('Unknown option {}; options: {}'.format(a,', '.join(sorted(o))))
+        o[k] = v.lower() in ('1','on','true','yes') if isinstance(o[k],bool) else type(o[k])(v)
+    here = os.path.dirname(os.path.abspath(__file__))
+    corpus = [os.path.join(here,f) for f in o['inputs'].split(',') if f]
+    tmp = None
+    if o['dir']:
+        workdir = os.path.abspath(o['dir'])
+        os.makedirs(workdir,exist_ok=True)
+    else:
+        tmp = tempfile.TemporaryDirectory()
+        workdir = tmp.name
+
+    # The inputs go in workdir (the real ones as symlinks), since everything made from them goes next to them.
+    inputs = []
+    for f in corpus:
+        link = os.path.join(workdir,os.path.basename(f))
+        if not os.path.exists(link): os.symlink(f,link)
+        inputs.append(link)
+    rng = random.Random(o['seed'])
+    for s in [s for s in o['synthetic'].split(',') if s]:
+        f = os.path.join(workdir,'synth{}.txt'.format(s))
+        if not os.path.exists(f) or abs(os.path.getsize(f) - size(s)) > BLOCK:
+            if '--json' not in sys.argv: print('Making {} ...'.format(f))
+            synthesize(f,size(s),corpus,rng)
+        inputs.append(f)
+
+    results = []
+    c = Cluster(o,workdir)
+    try:
+        # With --json, stdout is just the JSON (cli.shuffle_reduce() says what it did, for one).
+        with contextlib.redirect_stdout(sys.stderr) if '--json' in sys.argv else contextlib.nullcontext():
+            for f in inputs:
+                for r in run(c,f,o):
+                    r.update({'input':os.path.basename(f),'bytes':os.path.getsize(f)})
+                    results.append(r)
+                    if '--json' not in sys.argv: show(r,header=len(results)==1)
+    finally:
+        c.kill()
+        if tmp is not None: tmp.cleanup()
+    rss = {
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*1024,  # KB on Linux
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024,
+        }
+    if '--json' in sys.argv:
+        print(json.dumps({'commit':git_commit(),'options':o,'results':results,'peak_rss':rss},indent=1))
+    else:
+        print('peak rss: {:.1f} MB in any child process, {:.1f} MB here'.format(rss['children']/2**20,rss['self']/2**20))
+
+
+def show(r,header=False):
+    cols = ['input','MB','phase','secs','MB/s','in MB','out MB','io MB','rss MB']
+    if header: print(' '.join('{:>10}'.format(c) for c in cols))
+    mb = lambda b: '-' if b is None else '{:.1f}'.format(b/2**20)
+    row = [r['input'][:10],mb(r['bytes']),r['phase'] + ('' if r.get('ok',True) else '!'),'{:.2f}'.format(r['secs']),
+           '{:.1f}'.format(r['in']/2**20/r['secs']) if r['secs'] else '-',
+           mb(r['in']),mb(r['out']),mb(r['io']),mb(r['rss'])]
+    print(' '.join('{:>10}'.format(x) for x in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark for replication: start 3 PRMs on localhost, fire N replicate
+# commands at one of them as fast as we can, and time how long it takes until all N
+# are in the log. Runs the serial path (one entry per consensus round) and then the
+# pipelined one (--window/--batch, see paxosreplicator.py), so they can be compared.
+#
+#   ./bench_replicate.py [N] [WINDOW] [BATCH] [WORDS]     (default 40 8 8 2000)
+
+import sys, os, time, json, random, tempfile, subprocess
+import network
+
+PORTS = [7301,7302,7303]
+HOST = '127.0.0.1'
+
+
+def make_files(d,n,words):
+    # n little reduced files of 'words' distinct words each.
+    vocab = ['w{}'.format(i) for i in range(4*words)]
+    fs = []
+    for k in range(n):
+        f = os.path.join(d,'bench{}_reduced'.format(k))
+        json.dump({w:random.randint(1,100) for w in random.sample(vocab,words)},open(f,'w'))
+        fs.append(f)
+    return fs
+
+
+def run(fs,flags):
+    here = os.path.dirname(os.path.abspath(__file__))
+    prms = []
+    for j,port in enumerate(PORTS):
+        args = [sys.executable,'-u',os.path.join(here,'paxosreplicator.py')] + flags + [HOST,str(port)]
+        for other in PORTS[:j]+PORTS[j+1:]: args += [HOST,str(other)]
+        out = subprocess.PIPE if j == 0 else subprocess.DEVNULL
+        prms.append(subprocess.Popen(args,stdout=out,stderr=subprocess.STDOUT,universal_newlines=True))
+    time.sleep(1)  # let them start listening
+    try:
+        t0 = time.time()
+        for f in fs:
+            network.send((HOST,PORTS[0]),{'cmd':'replicate','filename':f})
+        done = failed = 0
+        for line in prms[0].stdout:
+            if line.startswith('Good news'): done += 1
+            elif line.startswith('Sorry'): failed += 1
+            if done + failed == len(fs): break
+        secs = time.time() - t0
+    finally:
+        for port in PORTS: network.send((HOST,port),{'cmd':'k'})
+        for p in prms: p.wait()
+    return secs,done,failed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv)>1 else 40
+    window = int(sys.argv[2]) if len(sys.argv)>2 else 8
+    batch = int(sys.argv[3]) if len(sys.argv)>3 else 8
+    words = int(sys.argv[4]) if len(sys.argv)>4 else 2000
+    configs = [
+        ('serial',    []),
+        ('pipelined', ['--window={}'.format(window),'--batch={}'.format(batch)]),
+    ]
+    with tempfile.TemporaryDirectory() as d:
+        fs = make_files(d,n,words)
+        print('{} replicate cmds, {} words each'.format(n,words))
+        print('{:<12} {:<22} {:>8} {:>8} {:>10}'.format('mode','flags','secs','failed','entries/s'))
+        for name,flags in configs:
+            secs,done,failed = run(fs,flags)
+            print('{:<12} {:<22} {:>8.2f} {:>8} {:>10.1f}'.format(name,' '.join(flags) or '-',secs,failed,done/secs))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,47 @@
 #!/usr/bin/env python3
 
-import sys, time
+import sys, time, threading
+import concurrent.futures
 from debug import debug
 import network
+import codec
+import intermediate
+import mapper
+import reducer
 
 ##########################################################
 
 
+def parse_addrs(args):
+    """
+    Either the original
+        cli.py MY MAP1 MAP2 RED PAXOS
+    or, for any number of mappers and reducers,
+        cli.py MY PAXOS -m MAP1 MAP2 ... -r RED1 RED2 ...
+    where each address is 'host port'.
+    Returns MY_ADDR, MAP_ADDRS, RED_ADDRS, PAXOS_ADDR.
+    """
+    lists = {None:[], '-m':[], '-r':[]}
+    cur = None
+    i = 0
+    while i < len(args):
+        if args[i] in lists:
+            cur = args[i]
+            i += 1
+        else:
+            lists[cur].append((args[i],int(args[i+1])))
+            i += 2
+    if cur is None:
+        MY_ADDR, MAP1_ADDR, MAP2_ADDR, RED_ADDR, PAXOS_ADDR = lists[None]
+        return MY_ADDR, [MAP1_ADDR,MAP2_ADDR], [RED_ADDR], PAXOS_ADDR
+    MY_ADDR, PAXOS_ADDR = lists[None]
+    return MY_ADDR, lists['-m'], lists['-r'], PAXOS_ADDR
+
+
 def main():
     # PORT = int(sys.argv[1]) if len(sys.argv)>1 else 5000
 
-    MY_ADDR     = (sys.argv[1], int(sys.argv[2]  ))
-    MAP1_ADDR   = (sys.argv[3], int(sys.argv[4]  ))
-    MAP2_ADDR   = (sys.argv[5], int(sys.argv[6]  ))
-    RED_ADDR    = (sys.argv[7], int(sys.argv[8]  ))
-    PAXOS_ADDR  = (sys.argv[9], int(sys.argv[10] ))
+    MY_ADDR, MAP_ADDRS, RED_ADDRS, PAXOS_ADDR = parse_addrs(sys.argv[1:])
 
     # PORT, PORT_M1, PORT_M2, PORT_RED, PORT_PAXOS = [int(p) for p in sys.argv[1:]]
 
@@ -22,6 +49,30 @@ def main():
 
     prev = None # previous cmd
 
+    # Knobs that get passed along to the mappers/reducer in their task dicts.
+    # Change them with 'set name value'.
+    opts = {
+        'combine': False,   # mappers emit <word,count> once per word instead of <word,1> per token
+        'format': 'bin',    # intermediate file format: 'bin', or 'json' for debugging
+        'compress': False,  # zlib-compress 'bin' intermediate files
+        'procs': 1,         # processes per mapper; >1 tokenizes each split on that many cores
+        'memory': 0,        # reducer memory budget in MB for an external merge; 0 = reduce in memory
+        }
+    def task(**kw):
+        kw.update(opts)
+        kw['partitions'] = len(RED_ADDRS)  # mappers hash-partition their output, one partition per reducer
+        return kw
+
+    # Sends don't block the prompt, even if the other end is down.
+    # If a msg can't be delivered before its deadline, say so.
+    def send(addr,d):
+        def report(fut):
+            if fut.exception() is not None:
+                print("\nCouldn't deliver '{}' to {}: {!r}".format(d.get('cmd',''),addr,fut.exception()))
+        fut = network.send(addr,d)
+        fut.add_done_callback(report)
+        return fut
+
     # When a msg comes back to me from the mapper, reducer, or PRM, 
     # I'm expecting it to reply with a certain string.
     def replyfn(b):
@@ -34,12 +85,38 @@ def main():
         else:
             debug("Hm, he replied with something I didn't expect: {}".format(b))
 
+    # Queries wait for the PRM's answer. Returns it, or None if we couldn't get one.
+    def ask(d):
+        try:
+            b = network.send(PAXOS_ADDR,d,replyfn=lambda b: None).result()
+        except (network.DeliveryExpired,network.ConnectionClosedError) as e:
+            print("Couldn't ask the PRM: {!r}".format(e))
+            return None
+        if not b:
+            print("The PRM couldn't answer that.")
+            return None
+        r = codec.loads(b)
+        if 'error' in r:
+            print(r['error'])
+            return None
+        if r['consistency'] == 'bounded':
+            print('(log up to slot {}, at most {:.2f} secs old)'.format(r['applied'],r['age']))
+        elif r['consistency'] == 'linearizable':
+            print('(log up to slot {}, up to date)'.format(r['applied']))
+        return r
+
     while True:
         cmdline = input('Cmd: ')
         if len(cmdline.strip()) == 0 and prev is not None: cmdline = prev  # blank line repeats prev cmd
         tokens = cmdline.split()
         cmd = tokens[0]
         d = {'cmd':cmd}
+        if cmd in ('total','merge','count','top'):
+            flags,tokens = consistency(tokens)
+            if flags is None:
+                print('Queries take --local (the default), --bounded[=SECS] or --linearizable')
+                continue
+            d.update(flags)
 
         if cmd=='help' or cmd=='h':
             print("""
@@ -51,28 +128,24 @@ def main():
                 • total pos1 pos2 ...
                 • print
                 • merge pos1 pos2
+                • count word pos1 pos2 ...
+                • top k pos1 pos2 ...
+                  (queries take --local, --bounded[=SECS] or --linearizable)
                 • cat filename1 filename2 ...
+                • set [option value]
                 """)
             continue
 
         elif cmd=='map':
-            '''splits the file based on its size into 2 equal parts. 
-            The split has to cut the file in a space character, not in the middle of a word. 
-            Then it maps each half to a mapper using message passing.'''
+            '''splits the file based on its size into as many equal parts as there are mappers.
+            The split has to cut the file in a whitespace character, not in the middle of a word.
+            Then it maps each part to a mapper using message passing.'''
             if len(tokens)<2:
                 print('USAGE: map filename')
                 continue
             f = tokens[1]
-            s = open(f,'r').read()
-            n = len(s)
-            i = n//2
-            while i<n: # break between words
-                if s[i] == ' ': break
-                i += 1
-            d1 = {'filename':f, 'offset':0, 'size':i}
-            d2 = {'filename':f, 'offset':i, 'size':n-i}
-            network.send(MAP1_ADDR,d1)
-            network.send(MAP2_ADDR,d2)
+            for addr,(offset,size) in zip(MAP_ADDRS,mapper.split(f,len(MAP_ADDRS))):
+                send(addr,task(filename=f, offset=offset, size=size))
 
         elif cmd=='reduce':
             '''sends a message (using sockets) to the reducer with the 
@@ -82,8 +155,13 @@ def main():
                 print('USAGE: reduce f_I_1 f_I_2')
                 continue
             fs = tokens[1:]
-            d = {'filenames':fs}
-            network.send(RED_ADDR,d)
+            if len(RED_ADDRS) == 1:
+                d = task(filenames=fs)
+                send(RED_ADDRS[0],d)
+            else:
+                # Reducer p gets partition p from every mapper. They all run at once;
+                # a background thread waits for them and then stitches the outputs together.
+                threading.Thread(target=shuffle_reduce, daemon=True, args=[RED_ADDRS,fs,task]).start()
 
         elif cmd=='replicate':
             '''sends a message to the PRM to replicate the file with
@@ -94,7 +172,7 @@ def main():
                 continue
             f = tokens[1]
             d.update({'filename':f})
-            network.send(PAXOS_ADDR,d)
+            send(PAXOS_ADDR,d)
 
         elif cmd=='stop':
             '''moves the PRM to the stopped state. When the PRM in the stopped
@@ -102,19 +180,19 @@ def main():
             drops any log object replicating messages sent by other PRMs in other
             nodes. This is used to emulate failures and how Paxos can still achieve
             progress in the presence of N/2 − 1 failures.'''
-            network.send(PAXOS_ADDR,d)
+            send(PAXOS_ADDR,d)
 
         elif cmd=='resume':
             '''resumes the PRM back to the active state. A PRM in the
             active state should actively handle local replicate commands 
             as well as log object repli- cating messages received by other PRMs.'''
-            network.send(PAXOS_ADDR,d)
+            send(PAXOS_ADDR,d)
 
 
         # DATA QUERY CALLS
-        #￼The CLI sends a query to the PRM, and the PRM prints
-        # the answers to these queries in its stdout. There is no
-        # need to pass the results back to the CLI. The supported data query calls are:
+        # The CLI sends a query to the PRM, and the PRM sends back the answer,
+        # which we print here. Big answers come a page at a time.
+        # The supported data query calls are:
 
         elif cmd=='total':
             '''sums up the counts of all the word in all the log positions pos1 pos2,...'''
@@ -123,11 +201,12 @@ def main():
                 print('USAGE: total logpos1 logpos2 ...')
                 continue
             d.update({'logpositions':logpositions})
-            network.send(PAXOS_ADDR,d)
+            r = ask(d)
+            if r is not None: print(r['total'])
 
         elif cmd=='print':
             '''prints the filenames of all the log objects.'''
-            network.send(PAXOS_ADDR,d)
+            send(PAXOS_ADDR,d)
 
         elif cmd=='merge':
             '''apply the reduce function in log objects in positions pos1 pos2. 
@@ -138,7 +217,33 @@ def main():
                 print('USAGE: merge logpos1 logpos2 ...')
                 continue
             d.update({'logpositions':logpositions})
-            network.send(PAXOS_ADDR,d)
+            while True:
+                r = ask(d)
+                if r is None: break
+                for w,c in r['words']: print(w,c)
+                if r['next'] is None: break
+                if input('-- more? [Y/n] ').strip().lower() in ('n','no','q'): break
+                d['after'] = r['next']
+
+        elif cmd=='count':
+            '''adds up the occurrences of one word in the log objects in positions pos1 pos2,...'''
+            logpositions = [int(i) for i in tokens[2:]]
+            if len(logpositions) == 0:
+                print('USAGE: count word logpos1 logpos2 ...')
+                continue
+            d.update({'word':tokens[1],'logpositions':logpositions})
+            r = ask(d)
+            if r is not None: print(r['word'],r['count'])
+
+        elif cmd=='top':
+            '''the k most common words in the log objects in positions pos1 pos2,... together.'''
+            if len(tokens) < 3:
+                print('USAGE: top k logpos1 logpos2 ...')
+                continue
+            d.update({'k':int(tokens[1]),'logpositions':[int(i) for i in tokens[2:]]})
+            r = ask(d)
+            if r is not None:
+                for w,c in r['words']: print(w,c)
 
         # Justin-specific commands
 
@@ -149,11 +254,39 @@ def main():
             fs = tokens[1:]
             for f in fs:
                 print('File "{}":'.format(f))
-                print(open(f,'r').read())
+                if intermediate.is_binary(f):
+                    print(intermediate.read(f))
+                else:
+                    print(open(f,'r').read())
                 print('')
 
+        elif cmd=='set':
+            if len(tokens)==1:
+                for k,v in sorted(opts.items()): print('{} = {}'.format(k,v))
+                continue
+            if len(tokens)!=3 or tokens[1] not in opts:
+                print('USAGE: set [option value], options: {}'.format(', '.join(sorted(opts))))
+                continue
+            k,v = tokens[1],tokens[2]
+            if isinstance(opts[k],bool):
+                if v.lower() not in ('1','on','true','yes','0','off','false','no'):
+                    print('{} is on or off, not {}'.format(k,v))
+                    continue
+                opts[k] = v.lower() in ('1','on','true','yes')
+            elif k=='format' and v not in intermediate.FORMATS:
+                print('format must be one of {}'.format(intermediate.FORMATS))
+                continue
+            else:
+                try:
+                    opts[k] = type(opts[k])(v)
+                except ValueError:
+                    print('USAGE: set {} {}, not {}'.format(k,type(opts[k]).__name__,v))
+                    continue
+            print('{} = {}'.format(k,opts[k]))
+
         elif cmd=='kill' or cmd=='k':
-            [ network.send(p,d) for p in [MAP1_ADDR,MAP2_ADDR,RED_ADDR,PAXOS_ADDR] ]
+            futs = [ send(p,d) for p in MAP_ADDRS+RED_ADDRS+[PAXOS_ADDR] ]
+            concurrent.futures.wait(futs,timeout=network.DEADLINE)  # don't exit before they're out the door
             break
 
         elif cmd=='q':
@@ -165,6 +298,50 @@ def main():
         prev = cmdline
     print('Bye bye!')
 
+def consistency(tokens):
+    # Take a query's consistency flag out of its tokens: --local (the default; whatever the
+    # PRM has), --bounded[=SECS] (at most SECS out of date) or --linearizable (up to date).
+    # Returns (the msg fields for it, the other tokens), or (None,None) for a bad flag.
+    flags = {}
+    rest = []
+    for t in tokens:
+        if t.startswith('--'):
+            level,_,secs = t[2:].partition('=')
+            if level not in ('local','bounded','linearizable'): return None,None
+            flags['consistency'] = level
+            if secs:
+                try: flags['staleness'] = float(secs)
+                except ValueError: return None,None
+        else:
+            rest.append(t)
+    return flags,rest
+
+def shuffle_reduce(RED_ADDRS,fs,task):
+    # Returns whether it worked: if any reducer didn't say it was done, its partition
+    # would be missing from the output, so we don't stitch them together at all.
+    R = len(RED_ADDRS)
+    replies = [None]*R
+    def reduce_part(p,addr,d):
+        try:
+            replies[p] = network.send(addr,d,lambda b: None).result()  # wait for 'Done!'
+        except (network.DeliveryExpired,network.ConnectionClosedError) as e:
+            replies[p] = e
+    threads = []
+    for p,addr in enumerate(RED_ADDRS):
+        d = task(filenames=['{}_{}'.format(f,p) for f in fs], partition=p)
+        t = threading.Thread(target=reduce_part, args=[p,addr,d])
+        t.start()
+        threads.append(t)
+    for t in threads: t.join()
+    failed = [(addr,r) for addr,r in zip(RED_ADDRS,replies) if r != b'Done!']
+    if failed:
+        for addr,r in failed:
+            print('\nReducer {} failed on its partition: {!r}'.format(addr,r))
+        print('Not concatenating the partitions, the output would be missing some words.')
+        return False
+    reducer.concat([reducer.output_name(fs,p) for p in range(R)],reducer.output_name(fs))
+    return True
+
 #####################################################
 
 
@@ -0,0 +1,238 @@
+import pickle, struct, zlib, sys
+from array import array
+from intermediate import put_varint, get_varint  # (the same varints as the intermediate files)
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Turning messages into bytes and back.
+#
+# Every message used to be a raw pickle. Pickle is fine (and, being C, hard to beat)
+# for the small dicts the CLI and the Paxos nodes send, but a LogValue payload is a
+# whole file's wordcounts, and pickle spells out each word and count as separate objects.
+#
+# dumps() instead writes a one-byte header and then either
+#
+#   COMPACT  a small tagged binary encoding of None/bool/int/float/str/bytes/
+#            tuple/list/dict, plus any class registered with register(). Used when
+#            the whole msg is an object of a class registered with payload=True,
+#            i.e. a LogValue, which packs its words and counts into two flat byte
+#            strings. The bytes are always the same for the same LogValue, so the PRM
+#            can agree on their sha256 instead (see paxosreplicator.py).
+#   PICKLE   plain pickle, for everything else.
+#
+# Payloads bigger than COMPRESS_OVER bytes are compressed, with lz4 if it's installed
+# and zlib otherwise, as long as that actually makes them smaller.
+#
+# loads() also accepts a bare pickle (first byte 0x80), so older senders still work.
+
+PICKLE  = 0x01
+COMPACT = 0x02
+ZLIB    = 0x10
+LZ4     = 0x20
+
+COMPRESS_OVER = 4096
+
+class UnknownType(Exception): pass
+
+
+###############################################################
+# Compact encoding
+
+registry_by_class = {}  # class -> (code, encode fn)
+registry_by_code = {}   # code -> decode fn
+payloads = set()        # classes dumps() encodes compactly
+
+def register(cls,code,encode,decode,payload=False):
+    # encode(obj) returns a tuple of encodable fields; decode(*fields) rebuilds obj.
+    registry_by_class[cls] = (code,encode)
+    registry_by_code[code] = decode
+    if payload: payloads.add(cls)
+
+
+DOUBLE = struct.Struct('!d')
+
+
+def encode(buf,x):
+    t = type(x)
+    enc = encoders.get(t)
+    if enc is not None:
+        enc(buf,x)
+    elif t in registry_by_class:
+        code,fieldsfn = registry_by_class[t]
+        buf += b'X'
+        buf.append(code)
+        fields = fieldsfn(x)
+        put_varint(buf,len(fields))
+        for y in fields: encode(buf,y)
+    else:
+        raise UnknownType(t)
+
+def enc_none(buf,x):
+    buf += b'N'
+
+def enc_bool(buf,x):
+    buf += b'T' if x else b'F'
+
+def enc_int(buf,x):
+    buf += b'I'
+    put_varint(buf,(x << 1) if x >= 0 else ((-x << 1) - 1))  # zigzag
+
+def enc_float(buf,x):
+    buf += b'D'
+    buf += DOUBLE.pack(x)
+
+def enc_str(buf,x):
+    s = x.encode('utf-8')
+    buf += b'S'
+    put_varint(buf,len(s))
+    buf += s
+
+def enc_bytes(buf,x):
+    buf += b'B'
+    put_varint(buf,len(x))
+    buf += x
+
+def enc_tuple(buf,x):
+    buf += b't'
+    put_varint(buf,len(x))
+    for y in x: encode(buf,y)
+
+def enc_list(buf,x):
+    buf += b'l'
+    put_varint(buf,len(x))
+    for y in x: encode(buf,y)
+
+def enc_dict(buf,x):
+    buf += b'd'
+    put_varint(buf,len(x))
+    for k,v in x.items():
+        encode(buf,k)
+        encode(buf,v)
+
+encoders = {type(None):enc_none, bool:enc_bool, int:enc_int, float:enc_float, str:enc_str,
+            bytes:enc_bytes, bytearray:enc_bytes, tuple:enc_tuple, list:enc_list, dict:enc_dict}
+
+
+def decode(b,i):
+    dec = decoders[b[i]]
+    if dec is None: raise UnknownType('tag {!r}'.format(chr(b[i])))
+    return dec(b,i+1)
+
+def dec_none(b,i):  return None,i
+def dec_true(b,i):  return True,i
+def dec_false(b,i): return False,i
+
+def dec_int(b,i):
+    z,i = get_varint(b,i)
+    return ((z >> 1) if not z & 1 else -((z + 1) >> 1)),i
+
+def dec_float(b,i):
+    return DOUBLE.unpack_from(b,i)[0],i+DOUBLE.size
+
+def dec_str(b,i):
+    n,i = get_varint(b,i)
+    return str(b[i:i+n],'utf-8'),i+n
+
+def dec_bytes(b,i):
+    n,i = get_varint(b,i)
+    return bytes(b[i:i+n]),i+n
+
+def dec_items(b,i):
+    n,i = get_varint(b,i)
+    items = []
+    for _ in range(n):
+        y,i = decode(b,i)
+        items.append(y)
+    return items,i
+
+def dec_tuple(b,i):
+    items,i = dec_items(b,i)
+    return tuple(items),i
+
+def dec_dict(b,i):
+    n,i = get_varint(b,i)
+    d = {}
+    for _ in range(n):
+        k,i = decode(b,i)
+        d[k],i = decode(b,i)
+    return d,i
+
+def dec_ext(b,i):
+    code = b[i]
+    fields,i = dec_items(b,i+1)
+    return registry_by_code[code](*fields),i
+
+decoders = [None]*256
+for tag,dec in [('N',dec_none),('T',dec_true),('F',dec_false),('I',dec_int),('D',dec_float),('S',dec_str),
+                ('B',dec_bytes),('t',dec_tuple),('l',dec_items),('d',dec_dict),('X',dec_ext)]:
+    decoders[ord(tag)] = dec
+
+
+# Helpers for registered classes that carry big arrays of counts.
+
+def count_array(counts):
+    # An iterable of non-negative ints -> an array of the narrowest unsigned type that holds them all.
+    counts = list(counts)
+    m = max(counts,default=0)
+    for code in 'BHIQ':
+        if m < 1 << 8*array(code).itemsize:
+            break
+    return array(code,counts)
+
+def pack_counts(counts):
+    # An iterable of non-negative ints -> a typecode byte and little-endian count_array() of them.
+    # (An array that's already of an unsigned type goes as is.)
+    a = counts if isinstance(counts,array) and counts.typecode in 'BHIQ' else count_array(counts)
+    if sys.byteorder == 'big':
+        a = array(a.typecode,a)
+        a.byteswap()
+    return a.typecode.encode() + a.tobytes()
+
+def unpack_counts(b):
+    a = array(chr(b[0]))
+    a.frombytes(b[1:])
+    if sys.byteorder == 'big': a.byteswap()
+    return a
+
+
+###############################################################
+
+def dumps(obj,compress=True):
+    buf = None
+    if type(obj) in payloads:
+        try:
+            buf = bytearray()
+            encode(buf,obj)
+            kind = COMPACT
+        except UnknownType:
+            buf = None
+    if buf is None:
+        buf = pickle.dumps(obj,pickle.HIGHEST_PROTOCOL)
+        kind = PICKLE
+    if compress and len(buf) > COMPRESS_OVER:
+        if lz4 is not None:
+            z,flag = lz4.frame.compress(bytes(buf)),LZ4
+        else:
+            z,flag = zlib.compress(buf,1),ZLIB
+        if len(z) < len(buf):
+            return bytes([kind | flag]) + z
+    return bytes([kind]) + buf
+
+
+def loads(b):
+    if b[0] == 0x80:  # a bare pickle
+        return pickle.loads(b)
+    header = b[0]
+    body = bytes(b[1:])
+    if header & ZLIB:
+        body = zlib.decompress(body)
+    elif header & LZ4:
+        if lz4 is None: raise UnknownType('lz4-compressed msg, but lz4 is not installed')
+        body = lz4.frame.decompress(body)
+    if header & PICKLE:
+        return pickle.loads(body)
+    obj,i = decode(body,0)
+    return obj
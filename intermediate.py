@@ -0,0 +1,228 @@
+import json, struct, zlib
+
+# Reading and writing the mapper->reducer intermediate files {F}_I_{mapper_id}.
+#
+# Two formats:
+#
+#   'json'  [["It", 1], ["was", 1], ...]  Easy to eyeball, slow to parse. For debugging.
+#
+#   'bin'   A header followed by a sorted run of <word,count> records:
+#
+#             magic    4 bytes   b'MRI1'
+#             flags    1 byte    bit 0: payload is zlib-compressed
+#             nrecs    8 bytes   number of records
+#             nbytes   8 bytes   length of the (possibly compressed) payload
+#             crc      4 bytes   crc32 of the uncompressed payload
+#
+#           Each record in the payload is front-coded against the previous word,
+#           since the run is sorted and neighbours share long prefixes:
+#
+#             varint  number of leading bytes shared with the previous word
+#             varint  length of the rest of the word
+#             bytes   the rest of the word (utf-8)
+#             varint  count
+#
+# The reader sniffs the magic, so a reducer can be handed either kind.
+
+MAGIC = b'MRI1'
+HEADER = struct.Struct('!4sBQQI')
+COMPRESSED = 0x01
+
+FORMATS = ('json','bin')
+
+class CorruptIntermediateFile(Exception): pass
+
+
+def partition(word,R):
+    '''Which of the R reducers gets 'word'. Must agree across processes, so no hash().'''
+    return zlib.crc32(word.encode('utf-8')) % R
+
+
+def put_varint(buf,n):
+    while n >= 0x80:
+        buf.append((n & 0x7f) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+def get_varint(b,i):
+    # (n,i after it); IndexError if b ends first.
+    x = b[i]
+    if x < 0x80: return x,i+1  # the usual case
+    n = shift = 0
+    while True:
+        x = b[i]
+        i += 1
+        n |= (x & 0x7f) << shift
+        if x < 0x80: return n,i
+        shift += 7
+
+
+def write(path,pairs,fmt='json',compress=False):
+    '''Write an iterable of (word,count) pairs to 'path' in format 'fmt'.'''
+    if fmt == 'json':
+        json.dump([list(p) for p in pairs],open(path,'w'))
+    elif fmt == 'bin':
+        with open(path,'wb') as fd:
+            fd.write(encode(pairs,compress))
+    else:
+        raise ValueError('Unknown intermediate format {}, expected one of {}'.format(fmt,FORMATS))
+
+
+def encode(pairs,compress=False):
+    payload = bytearray()
+    prev = b''
+    n = 0
+    for w,c in sorted(pairs):
+        prev = put_record(payload,prev,w,c)
+        n += 1
+    crc = zlib.crc32(payload)
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload,1)
+        flags |= COMPRESSED
+    return HEADER.pack(MAGIC,flags,n,len(payload),crc) + payload
+
+
+def put_record(buf,prev,w,c):
+    # Append <w,c> to buf, front-coded against the previous word's utf-8 'prev'; returns w's.
+    wb = w.encode('utf-8')
+    shared = 0
+    m = min(len(prev),len(wb))
+    while shared < m and prev[shared] == wb[shared]: shared += 1
+    put_varint(buf,shared)
+    put_varint(buf,len(wb)-shared)
+    buf += wb[shared:]
+    put_varint(buf,c)
+    return wb
+
+
+def write_run(path,pairs,compress=False,chunk=1<<16):
+    """
+    Like write(path,pairs,'bin'), for pairs that are already sorted by word,
+    which are written out about 'chunk' bytes at a time instead of all being
+    built up in memory first. The header goes in last, once we know what's in it.
+    """
+    z = zlib.compressobj(1) if compress else None
+    n = nbytes = crc = 0
+    prev = b''
+    buf = bytearray()
+    with open(path,'wb') as fd:
+        fd.write(bytes(HEADER.size))
+        def flush(data):
+            nonlocal nbytes
+            if z is not None: data = z.compress(data)
+            fd.write(data)
+            nbytes += len(data)
+        for w,c in pairs:
+            prev = put_record(buf,prev,w,c)
+            n += 1
+            if len(buf) >= chunk:
+                crc = zlib.crc32(buf,crc)
+                flush(buf)
+                buf = bytearray()
+        crc = zlib.crc32(buf,crc)
+        flush(buf)
+        if z is not None:
+            tail = z.flush()
+            fd.write(tail)
+            nbytes += len(tail)
+        fd.seek(0)
+        fd.write(HEADER.pack(MAGIC,COMPRESSED if z is not None else 0,n,nbytes,crc))
+
+
+def read(path,fmt=None):
+    '''Return a list of (word,count) pairs from 'path'. If 'fmt' is None, figure it out from the file.'''
+    return list(iterate(path,fmt))
+
+
+def iterate(path,fmt=None,chunk=1<<16):
+    """
+    Yield the (word,count) pairs in 'path' one at a time.
+    A 'bin' file is streamed 'chunk' bytes at a time, so memory doesn't
+    grow with the file; its checksum is checked after the last record.
+    A 'json' file has no choice but to be parsed all at once.
+    """
+    if fmt is None:
+        fmt = 'bin' if is_binary(path) else 'json'
+    if fmt == 'json':
+        for p in json.load(open(path,'r')):
+            yield tuple(p)
+        return
+    elif fmt != 'bin':
+        raise ValueError('Unknown intermediate format {}, expected one of {}'.format(fmt,FORMATS))
+
+    with open(path,'rb') as fd:
+        h = fd.read(HEADER.size)
+        if len(h) < HEADER.size:
+            raise CorruptIntermediateFile('Truncated header')
+        magic,flags,n,nbytes,crc = HEADER.unpack(h)
+        if magic != MAGIC:
+            raise CorruptIntermediateFile('Bad magic {}'.format(magic))
+        z = zlib.decompressobj() if flags & COMPRESSED else None
+        left = nbytes      # payload bytes still on disk
+        check = 0          # running crc32 of the uncompressed payload
+        buf = b''
+        i = 0
+        prev = b''
+        for r in range(n):
+            while True:
+                try:
+                    j = i
+                    shared,j = get_varint(buf,j)
+                    k,j = get_varint(buf,j)
+                    if j+k > len(buf): raise IndexError
+                    wb = prev[:shared] + buf[j:j+k]
+                    c,j = get_varint(buf,j+k)
+                    break
+                except IndexError:
+                    # Record runs off the end of what we've read. Get more and try again.
+                    data = b''
+                    while not data and (left > 0 or z is not None):
+                        raw = fd.read(min(chunk,left))
+                        left -= len(raw)
+                        if len(raw) == 0 and left > 0:
+                            raise CorruptIntermediateFile('Expected {} more payload bytes'.format(left))
+                        if z is None:
+                            data = raw
+                        elif raw:
+                            data = inflate(z,raw)
+                        else:
+                            data = inflate(z,None)
+                            z = None
+                    if not data:
+                        raise CorruptIntermediateFile('Truncated payload')
+                    check = zlib.crc32(data,check)
+                    buf = buf[i:] + data
+                    i = 0
+            i = j
+            prev = wb
+            try:
+                w = wb.decode('utf-8')
+            except UnicodeDecodeError:
+                raise CorruptIntermediateFile('Record {} is not utf-8'.format(r))
+            yield w,c
+        # Drain whatever is left (nothing, in a well-formed file) so the checksum covers the whole payload.
+        rest = fd.read(left)
+        if z is not None:
+            rest = inflate(z,rest) + inflate(z,None)
+        if zlib.crc32(rest,check) != crc:
+            raise CorruptIntermediateFile('Checksum mismatch')
+        if i != len(buf) or rest or fd.read(1):
+            raise CorruptIntermediateFile('Trailing bytes after {} records'.format(n))
+
+
+def inflate(z,raw):
+    # z.decompress(raw), or z.flush() if raw is None, with a corrupt stream (or
+    # bytes after its end) raised as CorruptIntermediateFile.
+    try:
+        data = z.decompress(raw) if raw is not None else z.flush()
+    except zlib.error as e:
+        raise CorruptIntermediateFile('Bad compressed payload: {}'.format(e))
+    if z.unused_data:
+        raise CorruptIntermediateFile('Trailing bytes after the compressed payload')
+    return data
+
+
+def is_binary(path):
+    with open(path,'rb') as fd:
+        return fd.read(len(MAGIC)) == MAGIC
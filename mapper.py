@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 
-import sys, pickle, json
+import sys, mmap, re, threading, multiprocessing
+import concurrent.futures
 from collections import Counter
-from debug import debug
 import network
+import codec
+import intermediate
 import os
 
 
@@ -12,18 +14,23 @@ def main():
     MY_ADDR = (sys.argv[2], int(sys.argv[3]))
     
     def parser(b):
-        d = pickle.loads(b)
+        d = codec.loads(b)
         if 'cmd' in d and d['cmd']=='k': raise network.KillMe()
         filename = d['filename']
         offset = d['offset']
         size = d['size']
-        Map(ME,filename,offset,size)
+        combine = d.get('combine',False)
+        fmt = d.get('format','json')
+        compress = d.get('compress',False)
+        partitions = d.get('partitions',1)
+        procs = d.get('procs',1)
+        Map(ME,filename,offset,size,combine,fmt,compress,partitions,procs)
         return b'Done!'
 
     network.worker(MY_ADDR,parser)
 
 
-def Map(mapid,filename,offset,size):
+def Map(mapid,filename,offset,size,combine=False,fmt='json',compress=False,partitions=1,procs=1):
     """
     A mapper receives a text filename F (e.g. file1.txt), 
     an offset O (e.g. 0), and a size S(e.g. 1000). 
@@ -35,19 +42,119 @@ def Map(mapid,filename,offset,size):
     {F}_{I}_{mapper_id} where F is the original filename, 
     I means intermediate, and mapper_id is 
     the id of the current mapper.
+
+    If 'combine' is set, the mapper acts as its own combiner and
+    writes each distinct word once, as 〈word,count〉. The reducer
+    sums the counts either way, so it can't tell the difference.
+
+    'fmt' and 'compress' pick the on-disk format of the intermediate
+    file, see intermediate.py.
+
+    With 'partitions' R > 1 the output is split by word hash into
+    R files {F}_I_{mapper_id}_{p}, one for each of R reducers.
+
+    With 'procs' > 1 the split is cut into smaller chunks that are
+    tokenized by a pool of that many processes, and their results
+    are merged here before writing.
     """
     print('Mapping file {}, offset={}, size={}...'.format(filename,offset,size))
-    s = open(filename,'r').read(offset+size)[offset:]
-    debug('Read string:')
-    debug('\"{}\"'.format(s))
-    words = [w.strip() for w in s.split()]
-    # counts = Counter(words)    # According to the assignment, the mapper should only output <w,1> for w in words.
-    counts = [(w,1) for w in words]
+    if procs > 1:
+        chunks = [(filename,o,s,combine) for o,s in split(filename,procs*CHUNKS_PER_PROC,offset,size)]
+        results = get_pool(procs).map(map_chunk,chunks)
+    else:
+        results = [map_chunk((filename,offset,size,combine))]
+    if combine:
+        total = Counter()
+        for c in results: total.update(c)
+        counts = list(total.items())
+    else:
+        # According to the assignment, the mapper should only output <w,1> for w in words.
+        counts = [(w,1) for words in results for w in words]
     path,inname = os.path.split(filename)
     outname = '{}_I_{}'.format(inname,mapid)
     out = os.path.join(path,outname)
-    json.dump(counts,open(out,'w'))
-    print('Mapped to file',out)
+    if partitions == 1:
+        intermediate.write(out,counts,fmt,compress)
+        print('Mapped to file',out)
+    else:
+        parts = [[] for _ in range(partitions)]
+        for w,c in counts:
+            parts[intermediate.partition(w,partitions)].append((w,c))
+        for p,part in enumerate(parts):
+            intermediate.write('{}_{}'.format(out,p),part,fmt,compress)
+        print('Mapped to files {}_0 ... {}_{}'.format(out,out,partitions-1))
+
+
+CHUNKS_PER_PROC = 4  # more chunks than processes, so one slow chunk doesn't hold up the rest
+
+pool, pool_procs = None, 0
+pool_lock = threading.Lock()  # the worker may run two tasks at once
+
+def get_pool(procs):
+    '''A process pool of size 'procs', kept around between tasks.
+    Its processes come from a forkserver, not a fork of this one: by now the worker has
+    its selector and handler threads running, and a fork taken while one of them holds
+    a lock would leave that lock held forever in the child.'''
+    global pool, pool_procs
+    with pool_lock:
+        if pool is None or pool_procs != procs:
+            if pool is not None: pool.shutdown()
+            pool, pool_procs = concurrent.futures.ProcessPoolExecutor(
+                max_workers=procs,mp_context=multiprocessing.get_context('forkserver')), procs
+        return pool
+
+
+def map_chunk(args):
+    '''Runs in a pool process: a Counter of the chunk's words if combining, else the words in order.'''
+    filename,offset,size,combine = args
+    if combine:
+        return Counter(read_split(filename,offset,size))
+    return list(read_split(filename,offset,size))
+
+
+WORD = re.compile(rb'\S+')
+SPACE = re.compile(rb'\s')
+
+def read_split(filename,offset,size):
+    """
+    Yield the words in bytes [offset, offset+size) of the file.
+    The file is memory-mapped, so we only touch the pages in our split,
+    no matter how far into the file it starts. Offsets are byte offsets;
+    the CLI is expected to put split boundaries on whitespace.
+    """
+    with open(filename,'rb') as fd:
+        if size <= 0 or os.fstat(fd.fileno()).st_size == 0: return  # can't mmap an empty file
+        with mmap.mmap(fd.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            for m in WORD.finditer(mm,offset,offset+size):
+                yield m.group().decode('utf-8',errors='replace')
+
+
+def split(filename,k,offset=0,size=None,window=4096):
+    """
+    Cut bytes [offset, offset+size) of the file (default: all of it) into
+    k pieces of roughly equal size, each starting on a whitespace character
+    so no word is cut in half. Returns a list of k (offset,size) pairs;
+    some may be empty if there are fewer words than pieces.
+    Only a 'window'-sized chunk is read at each cut, never the whole file.
+    """
+    if size is None: size = os.stat(filename).st_size - offset
+    end = offset+size
+    bounds = [offset]
+    with open(filename,'rb') as fd:
+        for j in range(1,k):
+            i = max(offset + size*j//k, bounds[-1])
+            fd.seek(i)
+            while i < end:  # scan forward to the next whitespace
+                buf = fd.read(min(window,end-i))
+                if not buf: break
+                m = SPACE.search(buf)
+                if m:
+                    i += m.start()
+                    break
+                i += len(buf)
+            bounds.append(min(i,end))
+    bounds.append(end)
+    return [(a,b-a) for a,b in zip(bounds,bounds[1:])]
 
 
 if __name__ == '__main__':
@@ -1,5 +1,8 @@
-import socket, pickle, time, struct
+import socket, time, struct, threading, selectors, queue, random
+import concurrent.futures
+from collections import deque
 from debug import debug
+import codec
 
 class ConnectionClosedError(Exception): pass
 class KillMe(Exception): pass
@@ -15,48 +18,227 @@ def safely_close_socket(s):
 
 ###############################################################
 
-def send(addr,obj,replyfn=None):
-    # Pickle python object 'obj' into bytes and send to IP,Port 'addr'. 
-    # Try repeatedly to connect.
-    # If 'replyfn' is non-None, wait for a reply and
-    # call replyfn on it.
+# Every message on a connection is a frame: a fixed header, then 'length' bytes of payload.
+# 'msgid' numbers the requests on a connection so a reply can be matched to its request;
+# the reply frame carries the same msgid with the REPLY flag set. Only requests with
+# WANT_REPLY get a reply, so a sender that doesn't care never has replies piling up.
+FRAME = struct.Struct('!IIB')  # length, msgid, flags
+WANT_REPLY = 0x01
+REPLY      = 0x02
+
+
+def recv_exactly(s,n):
+    # Read exactly n bytes from socket s into a preallocated buffer.
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = s.recv_into(view[got:],n-got)
+        if k == 0: raise ConnectionClosedError()
+        got += k
+    return bytes(buf)
+
+def send_frame(s,msgid,flags,b):
+    s.sendall(FRAME.pack(len(b),msgid,flags) + b)
+
+def recv_frame(s):
+    length,msgid,flags = FRAME.unpack(recv_exactly(s,FRAME.size))
+    return msgid,flags,recv_exactly(s,length)
+
+
+class Connection(object):
+    """
+    A persistent TCP connection to one worker. Many messages go over it, one
+    frame each. Requests don't wait for their replies: a reader thread hands
+    each reply to the future registered under its msgid.
+    """
+    def __init__(self,addr):
+        self.addr = addr
+        self.lock = threading.Lock()
+        self.msgid = 0
+        self.waiting = {}  # msgid -> Future for the reply
+        self.closed = False
+        debug('send:','Connecting to addr',addr,'...')
+        self.sock = socket.create_connection(addr)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # small Paxos msgs shouldn't wait on Nagle
+        threading.Thread(target=self.read_replies, daemon=True).start()
+
+    def read_replies(self):
+        try:
+            while True:
+                rid,flags,reply = recv_frame(self.sock)
+                with self.lock:
+                    fut = self.waiting.pop(rid,None)
+                if fut is None or not flags & REPLY:
+                    debug('Dropping unexpected frame {} from {}'.format(rid,self.addr))
+                elif not fut.cancelled():
+                    fut.set_result(reply)
+        except (OSError,ConnectionClosedError) as e:
+            debug('Connection to {} closed: {}'.format(self.addr,e))
+        with self.lock:
+            self.closed = True
+            waiting, self.waiting = self.waiting, {}
+        for fut in waiting.values():
+            if not fut.cancelled(): fut.set_exception(ConnectionClosedError(self.addr))
+
+    def request(self,b,fut=None):
+        # Send b. If 'fut' is given, the reply will be set on it.
+        with self.lock:
+            if self.closed: raise ConnectionClosedError(self.addr)
+            self.msgid += 1
+            if fut is not None: self.waiting[self.msgid] = fut
+            try:
+                send_frame(self.sock,self.msgid,WANT_REPLY if fut is not None else 0,b)
+            except OSError:
+                self.waiting.pop(self.msgid,None)
+                raise
+            debug('Sent {} bytes as msg {} to {}.'.format(len(b),self.msgid,self.addr))
+
+    def close(self):
+        safely_close_socket(self.sock)
+
+
+class DeliveryExpired(Exception): pass
+
+DEADLINE    = 10.0   # secs a message may wait to be delivered before we give up on it
+BACKOFF_MIN = 0.05   # secs between connect attempts, doubling up to
+BACKOFF_MAX = 2.0
+
+class Outbox(object):
+    """
+    Messages waiting to go to one address, delivered in order by a background
+    thread. If the peer is down, the thread retries connecting with exponential
+    backoff and jitter, and messages whose deadline passes in the meantime are
+    failed with DeliveryExpired instead of being sent late.
+    """
+    def __init__(self,addr):
+        self.addr = addr
+        self.q = queue.Queue()
+        self.conn = None
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        backoff = BACKOFF_MIN
+        while True:
+            b,want_reply,deadline,fut = self.q.get()
+            while not fut.cancelled():
+                if time.time() > deadline:
+                    debug('Gave up on msg to {}: deadline passed.'.format(self.addr))
+                    fut.set_exception(DeliveryExpired(self.addr))
+                    break
+                try:
+                    if self.conn is None or self.conn.closed:
+                        self.conn = Connection(self.addr)
+                    self.conn.request(b,fut if want_reply else None)
+                    if not want_reply: fut.set_result(None)
+                    backoff = BACKOFF_MIN
+                    break
+                except (OSError,ConnectionClosedError) as e:
+                    debug('send: {} unreachable ({}), retrying in <= {} sec...'.format(self.addr,e,backoff))
+                    if self.conn is not None:
+                        self.conn.close()
+                        self.conn = None
+                    time.sleep(max(0,min(random.uniform(0,backoff),deadline-time.time())))
+                    backoff = min(2*backoff,BACKOFF_MAX)
+
+
+outboxes = {}  # (addr,channel) -> Outbox
+outboxes_lock = threading.Lock()
+
+def get_outbox(addr,channel=None):
+    with outboxes_lock:
+        if (addr,channel) not in outboxes:
+            outboxes[addr,channel] = Outbox(addr)
+        return outboxes[addr,channel]
+
+
+# How send() turns objects into bytes. Receivers decode with codec.loads(), which
+# also understands plain pickles, so this can be swapped for e.g. pickle.dumps.
+encode = codec.dumps
+
+
+def send(addr,obj,replyfn=None,deadline=DEADLINE,channel=None):
+    # Encode python object 'obj' into bytes with 'encode' and queue it for IP,Port 'addr'.
+    # Returns right away with a concurrent.futures.Future, which is done once
+    # the message is sent (result None), or fails with DeliveryExpired if it
+    # couldn't be delivered within 'deadline' secs. Callers may wait on it or ignore it.
+    # If 'replyfn' is non-None, wait for the reply to this message and
+    # call replyfn on it; then the future's result is the reply.
+    # Messages on different 'channel's to the same addr go over separate connections,
+    # so e.g. a few big transfers don't hold up the small messages queued behind them.
     # If srcaddr is provided, pass it on to socket.create_connection() (DESCOPED)
     # as the source address. I use IP/port combos as authentication. (maybe bad). (DESCOPED)
     debug('Gonna try to send {} to addr {}...'.format(obj,addr))
-    n = 0
-    while True:
-        try:
-            n += 1
-            debug('send:','Connecting to addr',addr,', attempt',n,'...')
-            s = socket.create_connection(addr)
-            break
-        except ConnectionRefusedError:
-            debug('send:','Cxn refused. Waiting 1 sec then trying again...')
-            time.sleep(1)
-    b = pickle.dumps(obj)
-    debug('Outgoing obj pickled into {} bytes...'.format(len(b)))
-    msg = b # no len prepended, just send the damn thing
-    s.sendall(msg)
-    debug('Sent {} bytes.'.format(len(msg)))
+    b = encode(obj)
+    debug('Outgoing obj encoded into {} bytes...'.format(len(b)))
+    fut = concurrent.futures.Future()
+    get_outbox(addr,channel).q.put((b,replyfn is not None,time.time()+deadline,fut))
     if replyfn is not None:
-        debug('Waiting for reply...')
-        replyfn(s.recv(1024))  # replies aren't very long, 1024 should be sufficient.
-    safely_close_socket(s)
+        replyfn(fut.result())
+    return fut
 
 
 #################################################################
 
 
-def worker(ADDR,f):
-    # Forever wait to accept a TCP connection on (host,port) address 'ADDR'.
-    # When some bytes b arrive, hand them and the incoming addr to f(b).
-    # The first 4 bytes specify the number of bytes that will follow.
-    # The function f should process the bytes. 
-    # The function f may return a byte-string 'replymsg', in which case this function
-    # sends it back to the stream the bytes came from.
+class Peer(object):
+    """
+    Server-side state for one incoming connection: the frame being read,
+    frames waiting for the handler, and reply bytes waiting to be written.
+    """
+    def __init__(self,sock,addr):
+        self.sock = sock
+        self.addr = addr
+        self.header = bytearray(FRAME.size)
+        self.buf = self.header     # what we're reading into: the header, then the payload
+        self.got = 0
+        self.msgid = self.flags = None
+        self.pending = deque()     # (msgid,flags,payload) frames not handled yet
+        self.busy = False          # is a handler thread working through 'pending'?
+        self.out = bytearray()     # reply frames not written yet
+        self.lock = threading.Lock()
+
+    def read(self):
+        # Read what's available. Returns the number of complete frames queued, or None on EOF.
+        n = 0
+        while True:
+            try:
+                k = self.sock.recv_into(memoryview(self.buf)[self.got:])
+            except BlockingIOError:
+                return n
+            if k == 0: return None
+            self.got += k
+            if self.got < len(self.buf): continue
+            if self.buf is self.header:
+                length,self.msgid,self.flags = FRAME.unpack(self.header)
+                self.buf = bytearray(length)  # preallocate the whole payload, no b += chunk
+                self.got = 0
+                if length > 0: continue
+            with self.lock:
+                self.pending.append((self.msgid,self.flags,self.buf))
+            n += 1
+            self.buf = self.header
+            self.got = 0
+
+
+def worker(ADDR,f,threads=8):
+    # Forever wait to accept TCP connections on (host,port) address 'ADDR'.
+    # Each connection carries any number of frames (see FRAME above); for each,
+    # hand the payload bytes b to f(b).
+    # The function f should process the bytes.
+    # The function f may return a byte-string 'replymsg', which is sent back
+    # on the same connection if the sender asked for a reply. If the answer isn't
+    # ready yet, f may instead return a concurrent.futures.Future for it: the reply
+    # is sent whenever that's set, and the handler thread moves on meanwhile.
     # The function f may raise network.KillMe, in which case this function exits, safely
     # closing the socket.
-    # TODO: implement an 'allowed addrs' list so that not just anyone can connect to the 
+    #
+    # One thread multiplexes all the sockets with a selector and only does I/O.
+    # Calls to f run on a pool of 'threads' threads, so a slow handler or a big
+    # payload trickling in from one sender doesn't hold up anyone else.
+    # Frames from the same connection are handled one at a time, in order;
+    # frames from different connections are handled concurrently, so f must be thread-safe.
+    # TODO: implement an 'allowed addrs' list so that not just anyone can connect to the
     # worker and pump jobs into it.
 
     print('Hi from Worker on addr',ADDR)
@@ -64,31 +246,133 @@ def worker(ADDR,f):
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # http://stackoverflow.com/questions/6380057/python-binding-socket-address-already-in-use to avoid "address in use"
     sock.bind(ADDR)
     sock.listen(10) # max # queued connections
-    while True:
-        try:
-            strm,addr = sock.accept() # blocks
-        except OSError as e:
-            debug('Accept error {}, quitting.'.format(e))
-            safely_close_socket(sock)
-            break
-        debug(strm.getsockname(),'-->',strm.getpeername(),'Accepted strm from addr',addr,'!')
-
-        # Simple: since we're using 1 TCP cxn per msg, the entire msg can be obtained
-        # by just recving over and over. When the sender shutdown()'s, our recv returns b''.
-        b = b''
+    sock.setblocking(False)
+
+    sel = selectors.DefaultSelector()
+    sel.register(sock,selectors.EVENT_READ)
+    wake_r,wake_w = socket.socketpair()  # handler threads poke this when they have replies to write
+    wake_r.setblocking(False)
+    sel.register(wake_r,selectors.EVENT_READ)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+    killed = threading.Event()
+    peers = {}  # sock -> Peer
+
+    def handle(peer):
+        # Work through peer's frames in order until there are none left.
         while True:
-            tmp = strm.recv(2048) 
-            if tmp == b'': break;
-            else: b += tmp
+            with peer.lock:
+                if not peer.pending or killed.is_set():
+                    peer.busy = False
+                    return
+                msgid,flags,b = peer.pending.popleft()
+            try:
+                replymsg = f(b)
+            except KillMe:
+                killed.set()
+                replymsg = b'Killed me.'
+            except Exception as e:
+                print('Handler for msg from {} raised {!r}'.format(peer.addr,e))
+                replymsg = None
+            if isinstance(replymsg,concurrent.futures.Future):
+                if flags & WANT_REPLY:
+                    replymsg.add_done_callback(lambda fut,peer=peer,msgid=msgid: reply_later(peer,msgid,fut))
+            elif flags & WANT_REPLY:
+                reply(peer,msgid,replymsg)
+            elif killed.is_set():
+                wake()
+
+    def wake():
         try:
-            replymsg = f(b)
-        except KillMe:
-            strm.sendall(b'Killed me.')
-            break 
-        if replymsg is not None:           
-            strm.sendall(replymsg)
-    print('killing...')
-    safely_close_socket(sock)
+            wake_w.send(b'x')
+        except OSError:
+            pass
+
+    def reply(peer,msgid,replymsg):
+        # Queue a reply frame for the selector thread to write. Any thread may call this.
+        if replymsg is None: replymsg = b''
+        with peer.lock:
+            peer.out += FRAME.pack(len(replymsg),msgid,REPLY) + replymsg
+        wake()
 
+    def reply_later(peer,msgid,fut):
+        # Runs on whichever thread set the Future f returned.
+        try:
+            replymsg = fut.result()
+        except Exception as e:
+            print('Reply for msg from {} failed with {!r}'.format(peer.addr,e))
+            replymsg = None
+        reply(peer,msgid,replymsg)
+
+    def drop(peer):
+        sel.unregister(peer.sock)
+        del peers[peer.sock]
+        safely_close_socket(peer.sock)
+
+    def flush(peer):
+        # Write as much pending reply data as the socket will take.
+        with peer.lock:
+            try:
+                k = peer.sock.send(peer.out) if peer.out else 0
+            except BlockingIOError:
+                k = 0
+            del peer.out[:k]
+            want = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.out else 0)
+        sel.modify(peer.sock,want,peer)
 
+    while not killed.is_set():
+        for key,mask in sel.select():
+            if key.fileobj is sock:
+                try:
+                    strm,addr = sock.accept()
+                except BlockingIOError:
+                    continue
+                except OSError as e:
+                    debug('Accept error {}, quitting.'.format(e))
+                    killed.set()
+                    break
+                debug(strm.getsockname(),'-->',strm.getpeername(),'Accepted strm from addr',addr,'!')
+                strm.setblocking(False)
+                strm.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                peer = peers[strm] = Peer(strm,addr)
+                sel.register(strm,selectors.EVENT_READ,peer)
+            elif key.fileobj is wake_r:
+                try:
+                    while wake_r.recv(4096): pass
+                except BlockingIOError:
+                    pass
+                for peer in list(peers.values()):
+                    if peer.out: flush(peer)
+            else:
+                peer = key.data
+                if mask & selectors.EVENT_WRITE:
+                    flush(peer)
+                if mask & selectors.EVENT_READ:
+                    try:
+                        n = peer.read()
+                    except OSError as e:
+                        debug('Connection from {} failed: {}'.format(peer.addr,e))
+                        n = None
+                    if n is None:
+                        debug('Connection from {} closed.'.format(peer.addr))
+                        drop(peer)
+                        continue
+                    with peer.lock:
+                        start = n > 0 and not peer.busy
+                        if start: peer.busy = True
+                    if start: pool.submit(handle,peer)
 
+    print('killing...')
+    for peer in list(peers.values()):
+        # Best effort to get the last replies (e.g. 'Killed me.') out before closing.
+        peer.sock.setblocking(True)
+        with peer.lock:
+            try:
+                peer.sock.sendall(peer.out)
+            except OSError:
+                pass
+        drop(peer)
+    pool.shutdown(wait=False)
+    sel.close()
+    wake_r.close()
+    wake_w.close()
+    safely_close_socket(sock)
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
-import sys, time, queue, threading, json, pickle
-from collections import Counter
-from PaxosNode import PaxosNode 
+import sys, os, time, queue, threading, json, hashlib, zlib
+import concurrent.futures
+from collections import deque
+from PaxosNode import MultiPaxosNode
 from debug import debug
 import network
+import codec
+import wal
+import query
 
 class UnknownMessageType(Exception): pass
 
@@ -12,19 +16,60 @@ class UnknownMessageType(Exception): pass
 #########################################################
 
 q = queue.Queue()
+q_lock = threading.Lock()  # so no query gets into q once we're killed, see shut_down()
+
+ATTEMPTS = 6  # timeouts in a row before we give up on getting a value into the log
+FETCH_AFTER = 0.5  # secs to wait for a pushed payload before asking for it
+
+# How long to wait for a slot before retrying, adapted to the RTTs we see (like TCP's RTO).
+RTO_INIT = 1.0  # before we've measured anything
+RTO_MIN  = 0.05
+RTO_MAX  = 4.0
+
+SYNC_CHUNK   = 1<<20  # bytes of payload per chunk of a catch-up transfer
+SYNC_TIMEOUT = 2.0    # secs without a chunk before we ask another PRM instead
+
+# Consistent reads, see serve_query().
+LEASE        = 1.0  # secs a leader's read lease lasts (see MultiPaxosNode)
+STALENESS    = 1.0  # default for how out of date a 'bounded' read may be, in secs
+READ_TIMEOUT = 5.0  # secs a read may wait for the log to be known up to date before we give up
+
+KILLED = 'The PRM was killed before it could answer.'
 
 def main():
 
-    myAddr      =  (sys.argv[1], int(sys.argv[2]))
-    otherAddrs  = [(sys.argv[i],int(sys.argv[i+1])) for i in range(3,len(sys.argv),2)] # allow any number of other PRMs.
+    # Options go first:
+    #   --classic    runs a full Paxos instance per log entry instead of Multi-Paxos with a stable leader.
+    #   --window=N   lets up to N of our log entries be in flight at once (default 1).
+    #   --batch=N    lets up to N replicate cmds share one log slot (default 1).
+    #   --state-dir=DIR  keeps acceptor state and the log in DIR, so they survive a crash/restart.
+    opts = dict(a[2:].partition('=')[::2] for a in sys.argv[1:] if a.startswith('--'))
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    myAddr      =  (args[0], int(args[1]))
+    otherAddrs  = [(args[i],int(args[i+1])) for i in range(2,len(args),2)] # allow any number of other PRMs.
 
-    p = PaxosReplicator(myAddr,otherAddrs)
+    p = PaxosReplicator(myAddr,otherAddrs,leader='classic' not in opts,
+                        window=int(opts.get('window',1)),batch=int(opts.get('batch',1)),
+                        state_dir=opts.get('state-dir'))
 
     # Need another thread to listen for Paxos replies. 
     # Otherwise, if we block here until PaxosReplicator.replicate() returns, we'll wait forever 
     # because he's waiting to rx from other Paxos nodes.
     def parser(b):
-        q.put(pickle.loads(b))
+        d = codec.loads(b)
+        if 'bulk' in d:
+            p.rx_bulk(d)  # payloads don't go thru the queue, see rx_bulk()
+            return b'Got it.'
+        if d.get('cmd') in query.QUERIES:
+            # The CLI waits for the answer. The main loop sets it, see answer(), or
+            # shut_down() if we're killed first; network.worker sends it back then,
+            # so no handler thread sits here waiting on a slow (e.g. linearizable) query.
+            d['reply'] = concurrent.futures.Future()
+            with q_lock:
+                if p.killed: return codec.dumps({'error':KILLED})
+                q.put(d)
+            return d['reply']
+        q.put(d)
         return b'Enqueued msg!'
 
     threading.Thread(target=network.worker, daemon=True, args=[myAddr,parser]).start()
@@ -36,19 +81,54 @@ def main():
 
 
 class LogValue(object):
-    """ File name and wordcounts:
-    self.filename = 'Pride and Prejudice.txt', 
-    self.counts = {'a':10, 'the': 12,...}
-    Q: Why make a whole class LogValue instead of just a dict?
-    A: Can't just be a dict because dicts are unhashable -- error in collections.Counter. Ugh.
+    """ File name and wordcounts, e.g. for
+    filename = 'Pride and Prejudice.txt', wordcounts = {'a':10, 'the': 12,...}:
+    self.words  = ('a', 'the', ...)     sorted, interned
+    self.counts = array([10, 12, ...])  the narrowest unsigned ints that hold them
+    self.total  = 22 + ...
+    A log entry can hold a big reduced file, so it's stored as two flat arrays rather
+    than a dict of thousands of little objects, and it's immutable: its total, hash and
+    digest (sha256 of its encoding) get computed at most once. Equal digests mean equal
+    values, so comparing two LogValues doesn't have to look at all their words.
     """
-    def __init__(self,filename,wordcounts):
-        self.filename = filename
-        self.wordcounts = wordcounts
+    __slots__ = ('filename','words','counts','total','_digest','_hash')
+
+    def __init__(self,filename,wordcounts=None,words=None,counts=None):
+        # Give either wordcounts (a dict), or words (sorted) and counts (an array) as decoded.
+        if wordcounts is not None:
+            words = tuple(sorted(wordcounts))
+            counts = codec.count_array(wordcounts[w] for w in words)
+        put = object.__setattr__
+        put(self,'filename',filename)
+        put(self,'words',tuple(map(sys.intern,words)))
+        put(self,'counts',counts)
+        put(self,'total',sum(counts))
+        put(self,'_digest',None)
+        put(self,'_hash',None)
+
+    def __setattr__(self,name,value):
+        raise AttributeError('LogValue is immutable')
+
+    def __reduce__(self):
+        # Pickled (e.g. inside a msg) as the same two flat strings as its payload, see codec.py.
+        try:
+            return (decode_logvalue,encode_logvalue(self))
+        except codec.UnknownType:
+            return (LogValue,(self.filename,None,self.words,self.counts))
+
+    @property
+    def wordcounts(self):
+        return dict(zip(self.words,self.counts))
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            object.__setattr__(self,'_digest',hashlib.sha256(codec.dumps(self,compress=False)).digest())
+        return self._digest
 
     def __str__(self):
         # Summarize the string if it's too long.
-        x = sorted(self.wordcounts.items())
+        x = list(zip(self.words,self.counts))
         if len(x)>10:
             c = x[:3] + ['...'] + x[-3:]
         else:
@@ -57,11 +137,52 @@ class LogValue(object):
 
     def __eq__(self,other):
         return isinstance(other, type(self)) \
-                and self.filename==other.filename \
-                and self.wordcounts==other.wordcounts
+                and (self is other or (self.total==other.total and self.digest==other.digest))
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self,'_hash',hash(self.digest))
+        return self._hash
+
+
+# On the wire, a LogValue is its filename, its words joined by NULs, and its counts array
+# as is, rather than a pickled dict of thousands of little objects.
+def encode_logvalue(x):
+    words = '\0'.join(x.words)
+    if words.count('\0') != max(len(x.words)-1,0):
+        raise codec.UnknownType('word with a NUL in it')  # let pickle deal with it
+    return (x.filename,words,codec.pack_counts(x.counts))
+
+def decode_logvalue(filename,words,counts):
+    counts = codec.unpack_counts(counts)
+    return LogValue(filename,words=words.split('\0') if len(counts) else (),counts=counts)
+
+codec.register(LogValue,3,encode_logvalue,decode_logvalue,payload=True)
+
+
+class Digest(object):
+    """
+    What Paxos agrees on in place of a LogValue: the sha256 of the LogValue's
+    encoding, and its size. The encoding itself (the payload) travels separately,
+    see PaxosReplicator.stage().
+    The random nonce tells apart two replicate cmds for the same file, which
+    would otherwise both think the one log entry they get is theirs.
+    """
+    def __init__(self,sha,size,nonce=b''):
+        self.sha = sha
+        self.size = size
+        self.nonce = nonce
+
+    def __str__(self):
+        return '<Digest {}... {} bytes>'.format(self.sha[:6].hex(),self.size)
+
+    def __eq__(self,other):
+        return isinstance(other, type(self)) and self.sha==other.sha and self.size==other.size and self.nonce==other.nonce
 
     def __hash__(self):
-        return hash((self.filename,tuple(sorted(self.wordcounts.items()))))
+        return hash((self.sha,self.nonce))
+
+codec.register(Digest,4,lambda x: (x.sha,x.size,x.nonce),Digest)
    
 
 #########################################################
@@ -71,33 +192,85 @@ class PaxosReplicator(object):
     Coordinates the Multi-Paxos algorithm between other PaxosReplicator instances,
     and takes commands from the Command-Line Interface (cli.py).
     """
-    def __init__(self,myAddr,otherAddrs):
+    def __init__(self,myAddr,otherAddrs,leader=True,window=1,batch=1,state_dir=None):
         self.running = True
+        self.killed = False
 
         self.myAddr = myAddr
         self.otherAddrs = otherAddrs
-        self.num_elems = 3 # there are 3 entries in our multi-paxos log.
-
-        # For each log element that we need to reach consensus on,
-        # make a PaxosNode, arrange to have its outgoing msgs
-        # tagged with its element index, and give it a function
-        # it can use to communicate with the other nodes' PaxosNodes 
-        # that correspond to that particular array element.
-        #
-        # Note the incredibly shitty "i=i" expr in the lambda. 
-        # Without it, the value i resolves to the max value of all i's in the range.
-        # (This is bad.)
-        self.paxosNodes = []
-        for i in range(self.num_elems):
-            p = PaxosNode(  nodeid=(self.myAddr,i),
-                            otherAddrs=[(o,i) for o in otherAddrs],
-                            sendfn=lambda d,i=i: network.send(d['to'][0],{'paxos':True,'elem':i,'msg':d}) # [0]: to get the IP addr from the (addr,elementindex) nodeid
-                         )
-            self.paxosNodes.append(p)
+
+        # The MultiPaxosNode keeps the log, which grows as values are chosen, and a PaxosNode
+        # for each log element that we still need to reach consensus on. It tags their
+        # outgoing msgs with the element index.
+        # We give it a function it can use to communicate with the other nodes'
+        # MultiPaxosNodes. With leader=True, it acts as a stable Multi-Paxos leader
+        # and skips Phase 1 for all but the first entry it proposes, and it
+        # keeps up to 'window' of our slots in flight at once, and can hold a read lease.
+        self.mp = MultiPaxosNode(nodeid=self.myAddr,
+                                 otherAddrs=otherAddrs,
+                                 sendfn=self.send,
+                                 leader=leader,
+                                 window=window,
+                                 lease=LEASE)
+
+        # Paxos only ever sees Digests, so its msgs stay small however big the files are.
+        # Each payload is pushed once to every other PRM over a separate 'bulk' channel,
+        # and a PRM that's missing one when its slot is decided asks around for it.
+        # With batch > 1, up to that many Digests that are waiting to be replicated
+        # go into one slot together, as a tuple. The log the CLI sees has them unpacked
+        # and decoded, one LogValue per entry.
+        self.window = window
+        self.batch = batch
+        self.pipelining = window > 1 or batch > 1
+        self.waiting = []   # (Digest, Future) for replicate cmds that haven't been proposed yet
+        self.entries = []   # the log, batches unpacked
+        self.queries = query.Queries(self.entries)  # answers (and remembers) the CLI's queries on it
+        self.applied = 0    # how many of self.mp's slots have been unpacked into self.entries
+        self.blobs = {}     # sha -> payload, for LogValues that aren't in self.entries yet
+        self.applied_at = {}  # sha -> position in self.entries of the LogValue with that payload
+        self.staged = {}      # Digest -> LogValue, for our replicate cmds until they're placed or given up on
+        self.missing = {}   # sha -> when to (next) ask the others for it
+        self.outstanding = []  # [slot value, Futures, when proposed, retried?] for what we've proposed that isn't in self.entries yet
+
+        # Everything happens in run()'s loop: msgs get handled as they come in, and a
+        # decision resolves the Futures of the replicate cmds it was for right away.
+        # Timers for retries and payload fetches set how long the loop waits for msgs.
+        self.cmds = deque()  # CLI cmds, handled in order (see serve_cli)
+        self.tasks = []      # (Future, is it a replicate?) for CLI cmds still in progress
+        self.srtt = None     # smoothed commit RTT, and its variation
+        self.rttvar = 0
+        self.rto = RTO_INIT
+        self.retry_at = None # when to retry if the log hasn't moved by then
+        self.stalled = 0     # retries in a row
+        self.slot = 0        # mp.first_undecided() as of the last check()
+        self.catching_up = None  # Future of a catch-up in progress, see catch_up()
+        self.sync_at = None      # when to give up on the PRM we asked and ask the next one
+        self.sync_tries = 0
+
+        # Queries that want a log that's up to date (see serve_query), and how we find out it is.
+        self.reads = []          # [query msg, Future, deadline, when it came in, slot index it needs applied, when that was known]
+        self.fresh_at = None     # when our log was last known to have everything chosen so far
+        self.read_at = None      # when to look at self.reads again
+        self.index_asked = {}    # id -> when we asked the leader for its read index
+        self.index_id = 0
+        self.index_waiting = []  # (addr, id) of PRMs waiting for a read index from us, the leader
+        self.lease_tries = 0     # lease requests in a row that got no lease
+
+        # With a state dir, every change to acceptor state, every decision and every payload
+        # goes into a write-ahead log. Paxos msgs we send are held back until the changes
+        # behind them are on disk, and everything from one go round run()'s loop shares one
+        # fsync, see commit().
+        self.wal = None
+        self.unsent = []        # Paxos msgs waiting for the next commit()
+        self.promised = None    # self.mp.promised as of the last commit()
+        if state_dir is not None:
+            self.wal = wal.WAL(state_dir)
+            self.recover()
 
 
     def get_log(self):
-        return [p.v for p in self.paxosNodes]
+        self.apply()
+        return self.entries
         # [
         #   LogValue('Pride and Prejudice', Count('a':100,'the':42,...)),
         #   LogValue('Animal Farm', Count(...)),
@@ -107,9 +280,148 @@ class PaxosReplicator(object):
 
     def run(self):
         while True:
-            d = q.get()
-            if 'cmd' in d and d['cmd']=='k': break
-            self.rx(d)
+            timeout = self.timeout()
+            try:
+                ds = [q.get(timeout=timeout)]
+            except queue.Empty:
+                ds = []
+            while not q.empty(): ds.append(q.get())  # take all there is, so replicates can batch up
+            for d in ds:
+                if 'cmd' in d:
+                    if d['cmd']=='k':
+                        self.shut_down(ds)
+                        if self.wal: self.wal.close()
+                        return
+                    self.cmds.append(d)
+                else:
+                    self.rx(d)
+            self.tick()
+            self.serve_cli()
+            self.flush()
+            self.commit()
+
+
+    def shut_down(self,ds):
+        # Killed. Every query still waiting for its answer (in ds, the msgs that came in with
+        # the kill, in q, queued or parked in self.reads) gets an error instead of its CLI
+        # never hearing back.
+        with q_lock:
+            self.killed = True
+        ds = list(ds) + list(self.cmds) + [r[0] for r in self.reads]
+        while not q.empty(): ds.append(q.get())
+        for d in ds:
+            if 'reply' in d and not d['reply'].done():
+                d['reply'].set_result(codec.dumps({'error':KILLED}))
+
+
+    def send(self,d):
+        # How the MultiPaxosNode sends msgs.
+        d = dict(d,paxos=True)
+        if self.wal:
+            self.unsent.append(d)
+        else:
+            network.send(d['to'],d)
+
+
+    def commit(self):
+        # Log whatever Paxos state changed since last time, make it durable with one fsync,
+        # and only then let out the msgs that depend on it.
+        mp = self.mp
+        if self.wal:
+            if mp.promised != self.promised:
+                self.wal.append(('promised',mp.promised))
+                self.promised = mp.promised
+            for i in sorted(mp.dirty):
+                v = mp.chosen(i)
+                if v is not None:
+                    self.wal.append(('chosen',i,v))
+                elif i in mp.slots:
+                    p = mp.slots[i]
+                    self.wal.append(('slot',i,p.highest_responded_prepreq,p.highest_accepted_proposal))
+            self.wal.sync()
+            unsent,self.unsent = self.unsent,[]
+            for d in unsent: network.send(d['to'],d)
+            if self.wal.want_snapshot(): self.wal.snapshot(self.state())
+        mp.dirty.clear()
+
+
+    def state(self):
+        # Everything a snapshot needs. Undecided slots' acceptor state, decided slots' values.
+        mp = self.mp
+        return {
+            'promised': mp.promised,
+            'values': [(i,v) for i,v in enumerate(mp.log()) if v is not None],
+            'slots': [(i,p.highest_responded_prepreq,p.highest_accepted_proposal) for i,p in mp.slots.items()],
+            'blobs': self.payloads(),
+            }
+
+
+    def payloads(self):
+        # sha -> payload, for everything we have: both what's waiting in self.blobs
+        # (copied, the network thread may be adding to it) and what's in self.entries.
+        blobs = dict(self.blobs)
+        for sha in list(self.applied_at): blobs[sha] = self.payload(sha)
+        return blobs
+
+
+    def recover(self):
+        # Rebuild from the state dir: the latest snapshot, then the WAL on top of it.
+        # Merges only ever move acceptor state forward, never back.
+        t0 = time.time()
+        state,records = self.wal.replay()
+        mp = self.mp
+        def promise(n):
+            if n > mp.promised: mp.promised = n
+        def slot(i,n,accepted):
+            if mp.chosen(i) is not None: return
+            p = mp.slot(i)
+            if n > p.highest_responded_prepreq: p.highest_responded_prepreq = n
+            if accepted is not None and (p.highest_accepted_proposal is None or accepted > p.highest_accepted_proposal):
+                p.highest_accepted_proposal = accepted
+        if state is not None:
+            promise(state['promised'])
+            for i,v in state['values']:
+                if v is not None: mp.decided(i,v)
+            for i,n,accepted in state['slots']: slot(i,n,accepted)
+            self.blobs.update(state['blobs'])
+        for r in records:
+            if r[0] == 'promised': promise(r[1])
+            elif r[0] == 'slot': slot(*r[1:])
+            elif r[0] == 'chosen': mp.decided(r[1],r[2])
+            elif r[0] == 'blob': self.blobs[r[1]] = r[2]
+        self.promised = mp.promised
+        mp.dirty.clear()
+        mp.restarted()
+        self.apply()
+        self.slot = mp.first_undecided()
+        print('Recovered {} log entries ({} slots decided, {} undecided) from {} in {:.2f} secs.'.format(
+            len(self.entries),mp.first_undecided(),len(mp.slots),self.wal.dir,time.time()-t0))
+
+
+    def timeout(self):
+        # How long run() can wait for msgs before a timer is due (None: forever).
+        due = list(self.missing.values())
+        if self.retry_at is not None: due.append(self.retry_at)
+        if self.sync_at is not None: due.append(self.sync_at)
+        if self.read_at is not None: due.append(self.read_at)
+        if self.reads: due.append(min(r[2] for r in self.reads))
+        if self.mp.next_tick() is not None: due.append(time.time() + self.mp.next_tick() - self.mp.clock())
+        return max(0,min(due)-time.time()) if due else None
+
+
+    def serve_cli(self):
+        # Handle CLI cmds in the order they came in. A cmd waits until the ones before it
+        # are done, except that while pipelining, replicates can start while others are
+        # still in flight.
+        while self.cmds:
+            self.tasks = [(f,r) for f,r in self.tasks if not f.done()]
+            d = self.cmds[0]
+            replicating = d['cmd']=='replicate' and d['filename'] is not None
+            if self.tasks and not (self.pipelining and replicating and all(r for f,r in self.tasks)):
+                return
+            self.cmds.popleft()
+            fut = self.rx(d)
+            if fut is not None: self.tasks.append((fut,replicating))
 
 
     def rx(self,d):
@@ -117,27 +429,104 @@ class PaxosReplicator(object):
             # A message from the CLI.
             cmd = d['cmd']
             if cmd=='replicate':
-                self.replicate(d['filename'])
+                return self.replicate(d['filename'])
             elif cmd=='stop':
                 self.stop()
             elif cmd=='resume':
-                self.resume()
-            elif cmd=='total':
-                self.total(d['logpositions'])
+                return self.resume()
+            elif cmd in query.QUERIES:
+                return self.serve_query(d)
             elif cmd=='print':
                 self.print()
-            elif cmd=='merge':
-                self.merge(d['logpositions'])
             else:
                 print('Not familiar with the command "{}", sry lol'.format(cmd))
         elif 'paxos' in d:
             # A message from some Paxos node. Route to my corresponding Paxos node.
             if self.running:
-                self.paxosNodes[d['elem']].rx(d['msg'])
+                self.mp.rx(d)
+                self.check()
+        elif 'index request' in d:
+            # A PRM wants to know how far its log has to be to be up to date, see serve_reads().
+            if self.running:
+                self.index_waiting.append((d['index request'],d['id']))
+                self.serve_reads()
+        elif 'read index' in d:
+            self.rx_read_index(d)
+        elif 'sync request' in d:
+            self.serve_sync(d['sync request'],d['first'])
+        elif 'synced' in d:
+            self.synced(d)
+        elif 'blob' in d:
+            # A payload came in (see rx_bulk), maybe one apply() was waiting for.
+            if d['blob'] in self.applied_at:
+                self.blobs.pop(d['blob'],None)  # it got applied while this was on its way
+                return
+            b = self.blobs.get(d['blob'])
+            if b is None: return  # given up on already
+            if self.wal: self.wal.append(('blob',d['blob'],b))
+            self.check()
+        else:
+            raise UnknownMessageType(d)
+
+
+    def rx_bulk(self,d):
+        # Payload msgs are handled right on the network thread: the main loop may be busy
+        # in replicate(), and nothing here touches Paxos state.
+        if not self.running: return
+        if d['bulk'] == 'blob':
+            if hashlib.sha256(d['data']).digest() != d['sha']:
+                print('Payload from {} does not match its digest, dropping it.'.format(d['from']))
+                return
+            if d['sha'] in self.applied_at: return  # we have it already
+            self.blobs[d['sha']] = d['data']
+            q.put({'blob':d['sha']})
+        elif d['bulk'] == 'fetch':
+            b = self.payload(d['sha'])
+            if b is not None: self.push(d['from'],d['sha'],b)
+        elif d['bulk'] == 'sync request':
+            q.put({'sync request':d['from'],'first':d['first']})  # the main loop owns the log
+        elif d['bulk'] == 'sync':
+            if zlib.crc32(d['data']) != d['crc']:
+                print('Catch-up chunk from {} is corrupt, dropping it.'.format(d['from']))
+                return
+            values,blobs = codec.loads(d['data'])
+            q.put({'synced':values,'blobs':blobs,'from':d['from'],'last':d['last']})
         else:
             raise UnknownMessageType(d)
 
 
+    def stage(self,v):
+        # Keep LogValue v's payload, push it to the other PRMs, and return the Digest that
+        # Paxos will agree on instead. (Not compressed here: the network layer does that.)
+        b = codec.dumps(v,compress=False)
+        x = Digest(hashlib.sha256(b).digest(),len(b),os.urandom(8))
+        self.blobs[x.sha] = b
+        if self.wal: self.wal.append(('blob',x.sha,b))
+        for a in self.otherAddrs: self.push(a,x.sha,b)
+        return x
+
+    def payload(self,sha):
+        # The payload with digest sha, or None if we don't have it. Once its LogValue is in
+        # self.entries we only keep that, and encode it again (to the same bytes) when asked.
+        b = self.blobs.get(sha)
+        if b is None:
+            i = self.applied_at.get(sha)
+            if i is not None: b = codec.dumps(self.entries[i],compress=False)
+        return b
+
+    def push(self,addr,sha,b):
+        network.send(addr,{'bulk':'blob','from':self.myAddr,'sha':sha,'data':b},channel='bulk')
+
+    def fetch(self,x):
+        # Ask the others for x's payload, if it's had a chance to arrive and we haven't just asked.
+        now = time.time()
+        if now < self.missing.setdefault(x.sha,now+FETCH_AFTER): return
+        debug('Fetching payload for {}'.format(x))
+        self.missing[x.sha] = now+1
+        for a in self.otherAddrs:
+            network.send(a,{'bulk':'fetch','from':self.myAddr,'sha':x.sha},channel='bulk')
+
+
     def replicate(self,f):
         """replicate the file with
         other computing nodes. Notice that the PRM owns 
@@ -157,56 +546,251 @@ class PaxosReplicator(object):
         another PRM is competing for the same log position, a replicate 
         command can fail. Therefore, the PRM has to retry replicating 
         the log object in the following log positions until it succeeds.
+
+        Returns a Future that's done once the log object is in the log
+        (result: its position) or we've given up (result: None).
         """
         if self.running: 
             print("Gonna read file {} and replicate its contents across the Paxos Nodes...".format(f))
         else:
             print("I'm not running, try 'resume' at CLI plz!")
-            return
+            return None
 
         if f is None:
             # Special value for "I just woke up, get me up-to-date."
-            v = None
-        else:
-            # Normal operation.
-            counts = json.load(open(f,'r'))
-            v = LogValue(filename=f,wordcounts=counts)  # the value we want to replicate across the other Paxos nodes
+            return self.catch_up()
 
+        # Normal operation.
+        v = self.read(f)  # the value we want to replicate across the other Paxos nodes
         print("Doing Multi-Paxos on LogValue:",v)
-        # Multi-paxos: insert v into the next available log entry and simultaneously reach consensus on it with the other Paxos nodes.
-        success = False
-        for i,p in enumerate(self.paxosNodes): # For each slot in the log,
-            if p.v is not None: continue  # skip locations that have already reached consensus 
-            attempts = 2
-            while p.v is None and attempts > 0:
-                debug('Hm, paxosnode={} has value v={} (None). Initiating Paxos {} more times to get v={} in elem {}...'.format(p,p.v,attempts,v,i))
-                p.initiate_paxos(v)  # propose v.
-                t0 = time.time()
-                while time.time()-t0 < 1:  # for 1 sec, check the msg Q and service paxos msgs from it.
-                    while not q.empty():
-                        d = q.get()
-                        if 'paxos' not in d:
-                            q.put(d) # whoops, a CLI cmd. Put it back. (Shit, now it's out of order... TODO)
-                        else:
-                            self.rx(d)
-                    time.sleep(.1)
-                attempts -= 1
-            if p.v == v: 
-                debug('Inserted v={} at position {} in log! Great success.'.format(v,i))
-                success = True
-                break
+        fut = concurrent.futures.Future()
+        x = self.stage(v)
+        self.staged[x] = v
+        self.waiting.append((x,fut))
+        return fut
+
+
+    def flush(self):
+        # Multi-paxos: insert our waiting values into the next available log entries and simultaneously
+        # reach consensus on them with the other Paxos nodes, batch-sized groups to a slot, as long
+        # as we have fewer than 'window' slots in flight. (A classic proposer does one at a time.)
+        while self.waiting and len(self.outstanding) < (self.window if self.mp.leader else 1):
+            group = self.waiting[:self.batch]
+            del self.waiting[:self.batch]
+            v = group[0][0] if len(group) == 1 else tuple(x for x,_ in group)
+            debug('Proposing v={}'.format(v))
+            if not self.outstanding: self.retry_at = time.time() + self.rto
+            self.outstanding.append([v,[fut for _,fut in group],time.time(),False])
+            self.mp.propose(v)
+
+
+    def check(self):
+        # After Paxos msgs: see what's been decided, and move on from there.
+        self.apply()
+        if self.reads or self.index_waiting: self.serve_reads()
+        slot = self.mp.first_undecided()
+        if slot != self.slot:
+            # The log moved. Give whatever we're waiting on a fresh timeout.
+            self.slot = slot
+            self.retry_at = time.time() + self.rto if self.outstanding else None
+            if not self.mp.leader and self.outstanding:
+                # Someone took the slot the classic proposer was after, go for the next one.
+                self.mp.propose(self.outstanding[0][0])
+
+
+    def tick(self):
+        # Timers. A stopped PRM has none: it sends nothing until it's resumed.
+        if not self.running: return
+        now = time.time()
+        self.mp.tick()
+        if self.missing and min(self.missing.values()) <= now:
+            self.apply()
+        if self.read_at is not None and now >= self.read_at:
+            self.serve_reads()
+        if self.reads and now >= min(r[2] for r in self.reads):
+            self.expire_reads(now)
+        if self.sync_at is not None and now >= self.sync_at:
+            self.sync_tries += 1
+            if self.sync_tries >= ATTEMPTS:
+                print("Couldn't get a catch-up transfer from anyone, giving up.")
+                self.caught_up()
             else:
-                debug('Looks like someone else put val {} at pos {} in the log instead of our v={}, trying next position...'.format(p.v,i,v))
-            if success: break 
-            
-        if success:
-            print('Good news, our value {} was accepted in position {} in the log!'.format(v,i))
+                self.ask_sync()
+        if self.retry_at is None or now < self.retry_at:
+            return
+        self.stalled += 1
+        self.rto = min(2*self.rto,RTO_MAX)  # back off, in case we were just too impatient
+        self.retry_at = now + self.rto
+        debug('Nothing new in the log for a while ({} times), rto={}'.format(self.stalled,self.rto))
+        if self.stalled >= ATTEMPTS:
+            given_up,self.outstanding = self.outstanding,[]
+            for v,futs,_,_ in given_up:
+                self.mp.withdraw(v)
+                for x,fut in zip(v if isinstance(v,tuple) else [v],futs):
+                    print("Sorry dude, for some reason we couldn't get our value {} in the log. WTF?".format(self.staged.pop(x)))
+                    fut.set_result(None)
+            for v,_,_,_ in given_up:
+                for x in (v if isinstance(v,tuple) else [v]):
+                    if not self.needed(x.sha): self.blobs.pop(x.sha,None)
+            self.stalled = 0
+            self.retry_at = None
+            self.print_log()
+            return
+        # Try again: the classic proposer picks the next undecided slot,
+        # the leader re-runs Phase 1 in case someone else has taken over.
+        for r in self.outstanding: r[3] = True
+        if self.mp.leader:
+            self.mp.retry()
         else:
-            print("Sorry dude, for some reason we couldn't get our value {} in the log. WTF?".format(v))
-            
+            self.mp.propose(self.outstanding[0][0])
+
+
+    def needed(self,sha):
+        # Might we still have to apply (or hand out) a payload with digest sha? Yes if one of our
+        # values still on its way has it (the same file replicated again, with another nonce), or
+        # any value accepted or decided but not applied here does: then this may be the only copy.
+        log = self.mp.log()
+        vs = [v for v,_,_,_ in self.outstanding] + [x for x,_ in self.waiting] + log[self.applied:]
+        vs += [p.highest_accepted_proposal.v for p in self.mp.slots.values() if p.highest_accepted_proposal is not None]
+        for v in vs:
+            for x in (v if isinstance(v,tuple) else [v]):
+                if x is not None and x.sha == sha: return True
+        return False
+
+
+    def placed(self,r,i):
+        # Our slot value r[0] made it into the log, with its first entry at position i.
+        v,futs,t0,retried = r
+        self.outstanding.remove(r)
+        for x in (v if isinstance(v,tuple) else [v]): self.staged.pop(x,None)
+        self.mp.withdraw(v)
+        self.stalled = 0
+        if not retried:
+            self.measured(time.time()-t0)
+        for j,fut in enumerate(futs):
+            print('Good news, our value {} was accepted in position {} in the log!'.format(self.entries[i+j],i+j))
+            fut.set_result(i+j)
+        if not self.outstanding and not self.waiting:
+            self.retry_at = None
+            self.print_log()
+
+
+    def measured(self,rtt):
+        # Same smoothing as TCP (RFC 6298).
+        if self.srtt is None:
+            self.srtt,self.rttvar = rtt,rtt/2
+        else:
+            self.rttvar = 0.75*self.rttvar + 0.25*abs(self.srtt-rtt)
+            self.srtt = 0.875*self.srtt + 0.125*rtt
+        self.rto = min(max(self.srtt + 4*self.rttvar,RTO_MIN),RTO_MAX)
+        debug('Commit took {:.4f} secs, srtt={:.4f} rto={:.4f}'.format(rtt,self.srtt,self.rto))
+
+
+    def apply(self):
+        # Unpack newly decided slots into self.entries, in slot order. A slot past one that's
+        # still undecided (or whose payloads we don't have yet) has to wait for it, or the
+        # positions could differ between PRMs.
+        log = self.mp.log()
+        while self.applied < self.mp.first_undecided():
+            v = log[self.applied]
+            xs = v if isinstance(v,tuple) else [v]
+            missing = [x for x in xs if x.sha not in self.blobs and x.sha not in self.applied_at]
+            if missing:
+                for x in missing: self.fetch(x)
+                break
+            i = len(self.entries)
+            for x in xs:
+                self.missing.pop(x.sha,None)
+                if x.sha in self.applied_at:
+                    self.entries.append(self.entries[self.applied_at[x.sha]])  # the same file again; LogValues don't change
+                else:
+                    self.entries.append(codec.loads(self.blobs[x.sha]))
+                    self.applied_at[x.sha] = len(self.entries)-1  # (only once it's there: payload() runs on network threads)
+                self.blobs.pop(x.sha,None)  # the entry has it now, see payload()
+                self.queries.added(len(self.entries)-1)
+            self.applied += 1
+            for r in self.outstanding:
+                if r[0] == v:
+                    self.placed(r,i)
+                    break
+
+
+    def read(self,f):
+        return LogValue(filename=f,wordcounts=json.load(open(f,'r')))
+
+
+    def catch_up(self):
+        # Learn what we missed. Returns a Future that's done when we think we're caught up.
+        # Rather than run Paxos on each slot we missed, we ask another PRM for everything it has
+        # decided from our first undecided slot on, and it streams us the values and payloads
+        # in one go (see serve_sync). Whatever gets decided after that, we hear about as usual.
+        fut = self.catching_up
+        if fut is None:
+            fut = self.catching_up = concurrent.futures.Future()
+            self.sync_tries = 0
+            if self.otherAddrs: self.ask_sync()
+            else: self.caught_up()
+        return fut
+
+    def ask_sync(self):
+        # Ask the next PRM in line. If it doesn't answer in time, tick() asks the one after.
+        to = self.otherAddrs[self.sync_tries % len(self.otherAddrs)]
+        debug('Asking {} for the log from slot {} on'.format(to,self.mp.first_undecided()))
+        network.send(to,{'bulk':'sync request','from':self.myAddr,'first':self.mp.first_undecided()},channel='bulk')
+        self.sync_at = time.time() + SYNC_TIMEOUT
+
+    def serve_sync(self,to,first):
+        # Stream PRM 'to' the slots we know are decided from 'first' on, with their payloads,
+        # in chunks of about SYNC_CHUNK bytes. Each chunk is checksummed as a whole.
+        if not self.running: return
+        def send(values,blobs,last):
+            b = codec.dumps((values,blobs),compress=False)  # (the network layer compresses)
+            network.send(to,{'bulk':'sync','from':self.myAddr,'data':b,'crc':zlib.crc32(b),'last':last},channel='bulk')
+        log = self.mp.log()
+        print('Sending slots {}..{} to {} so it can catch up.'.format(first,len(log),to))
+        values,blobs,size = [],{},0
+        for i in range(first,len(log)):
+            v = log[i]
+            if v is None: continue
+            values.append((i,v))
+            for x in (v if isinstance(v,tuple) else [v]):
+                b = self.payload(x.sha) if x.sha not in blobs else None
+                if b is not None:
+                    blobs[x.sha] = b
+                    size += len(b)
+            if size >= SYNC_CHUNK:
+                send(values,blobs,False)
+                values,blobs,size = [],{},0
+        send(values,blobs,True)
+
+    def synced(self,d):
+        # A chunk of a catch-up transfer. The values were chosen, so just take them.
+        # (Payloads we still don't have after the last chunk get fetched as usual.)
+        if not self.running: return
+        for sha,b in d['blobs'].items():
+            if sha not in self.blobs and sha not in self.applied_at and hashlib.sha256(b).digest() == sha:
+                self.blobs[sha] = b
+                if self.wal: self.wal.append(('blob',sha,b))
+        for i,v in d['synced']:
+            self.mp.decided(i,v)
+        self.check()
+        if self.catching_up is not None:
+            self.sync_at = time.time() + SYNC_TIMEOUT
+            if d['last']:
+                print('Caught up from {}, up to slot {}.'.format(d['from'],self.mp.first_undecided()))
+                self.caught_up()
+
+    def caught_up(self):
+        fut,self.catching_up = self.catching_up,None
+        self.sync_at = None
+        self.print_log()
+        fut.set_result(None)
+
+
+    def print_log(self):
         print("My local log is currently:")
         self.print()
-        
+
 
     def stop(self):
         '''moves the PRM to the stopped state. When the PRM in the stopped
@@ -216,6 +800,14 @@ class PaxosReplicator(object):
         progress in the presence of N/2 − 1 failures.'''        
         print('Disabling paxos...')
         self.running = False
+        # Reads waiting on the leader or the log would only time out, so fail them now.
+        for d,fut,_,_,_,_ in self.reads:
+            self.answer(d,d['consistency'],error="This PRM was stopped before it could answer.")
+            fut.set_result(None)
+        self.reads = []
+        self.index_waiting = []
+        self.read_at = None
+        self.index_asked = {}
 
     def resume(self):
         '''resumes the PRM back to the active state. A PRM in the
@@ -224,36 +816,170 @@ class PaxosReplicator(object):
 
         print('Enabling paxos...')
         self.running = True
-        print('Proposing a dummy value to update what I missed...')
-        self.replicate(None)
+        print('Asking the others for what I missed...')
+        return self.replicate(None)
 
 
 
     # DATA QUERY CALLS
-    #￼The CLI sends a query to the PRM, and the PRM prints
-    # the answers to these queries in its stdout. There is no
-    # need to pass the results back to the CLI. The supported data query calls are:
+    # The CLI sends a query to the PRM, and gets the answer back in the reply
+    # (see answer()); big answers come a page at a time. The PRM only prints the
+    # short ones in its stdout. The supported data query calls are:
 
 
     def total(self,logpositions):
         '''sums up the counts of all the words in all the log positions pos1 pos2,...
-        (and prints it?)'''
-        log = self.get_log()
-        print(sum(sum(log[p].wordcounts.values()) for p in logpositions if p < len(log) and log[p] is not None))
+        (and prints it)'''
+        r = self.queries.total(logpositions)
+        print(r['total'])
+        return r
 
     def print(self):
         '''prints the filenames of all the log objects.'''        
         for i,logval in enumerate(self.get_log()):
             print("\nLOG ENTRY {}: {}".format(i,logval))
 
-    def merge(self,logpositions):
+    def merge(self,logpositions,after=None,limit=query.PAGE):
         '''apply the reduce function in log objects in positions pos1 pos2. 
         In other words, it adds up the occurrence of words in log objects
-        in positions pos1 and pos2 and prints each word with its corresponding count.'''
-        c = Counter()
-        log = self.get_log()
-        [ c.update(log[p].wordcounts) for p in logpositions if p < len(log) and log[p] is not None ]
-        print([(k,v) for k,v in sorted(c.items())])
+        in positions pos1 and pos2, giving each word with its corresponding count.
+        Returns a page of up to 'limit' words, in order, starting after word 'after'.'''
+        return self.queries.merge(logpositions,after,limit)
+
+    def count(self,word,logpositions):
+        '''adds up the occurrences of one word in the log objects in positions pos1 pos2,...
+        (and prints it)'''
+        r = self.queries.count(word,logpositions)
+        print(r['count'])
+        return r
+
+    def top(self,k,logpositions):
+        '''the k most common words in the log objects in positions pos1 pos2,... together.'''
+        return self.queries.top(k,logpositions)
+
+    def serve_query(self,d):
+        # Each query says how up to date the log it reads has to be, d['consistency']:
+        #   'local'         (default) whatever this PRM has now.
+        #   'bounded'       everything chosen up to at most d['staleness'] secs ago.
+        #   'linearizable'  everything chosen before the query came in.
+        # For the last two we need a read index from the leader (see serve_reads), unless
+        # a recent one will do for 'bounded'. Every answer says which slots it covers:
+        # 'applied' is how many slots of the log it reflects.
+        # Returns a Future if the query has to wait.
+        level = d.get('consistency','local')
+        if level == 'local' or (level == 'bounded' and self.fresh_at is not None
+                                and time.time() - self.fresh_at <= d.get('staleness',STALENESS)):
+            self.answer(d,level)
+            return None
+        if not self.mp.leader:
+            self.answer(d,level,error='{} reads need a stable leader, and this PRM runs with --classic'.format(level))
+            return None
+        if not self.running:
+            self.answer(d,level,error="{} reads need a running PRM, try 'resume' at CLI plz!".format(level))
+            return None
+        fut = concurrent.futures.Future()
+        now = time.time()
+        self.reads.append([d,fut,now+READ_TIMEOUT,now,None,None])
+        self.serve_reads()
+        return fut
+
+    def serve_reads(self):
+        # Find out how far our log has to be to be up to date, and answer the reads that
+        # were waiting for it to get there.
+        # The leader knows, if it holds a read lease: see MultiPaxosNode.read_index().
+        # Anyone else asks the leader, and can use its answer for the reads that came in
+        # before it asked. Either way it takes no consensus round, and no disk write.
+        if not self.running: return  # stop() answered them all already
+        now = time.time()
+        mp = self.mp
+        retry = self.read_at is None or now >= self.read_at
+        if mp.has_lease():
+            self.lease_tries = 0
+            i = mp.read_index()
+            for r in self.reads:
+                if r[4] is None: r[4:] = [i,now]
+            for addr,k in self.index_waiting:
+                network.send(addr,{'read index':i,'id':k})
+            self.index_waiting = []
+        elif mp.is_leader():
+            if self.reads or self.index_waiting:
+                if mp.lease_n != mp.ballot:
+                    mp.request_lease()  # we've just become leader
+                elif retry:
+                    # No lease yet. If a couple of tries don't get us one, someone
+                    # else may have taken over without our hearing: run Phase 1 again.
+                    self.lease_tries += 1
+                    if self.lease_tries > 2:
+                        self.lease_tries = 0
+                        mp.retry()
+                    else:
+                        mp.request_lease()
+        else:
+            self.index_waiting = []  # they'll ask again, and find out who the leader is
+            if retry and any(r[4] is None for r in self.reads):
+                leader = mp.promised.id
+                if leader == self.myAddr:
+                    # No one else has been leader as far as we know. Then we'd better be.
+                    if mp.preparing is None: mp.prepare()
+                else:
+                    self.index_id += 1
+                    self.index_asked[self.index_id] = now
+                    network.send(leader,{'index request':self.myAddr,'id':self.index_id})
+        if retry: self.read_at = now + self.rto
+
+        for r in list(self.reads):
+            d,fut,_,_,i,known = r
+            if i is not None and self.applied >= i:
+                self.fresh_at = max(self.fresh_at or 0,known)
+                self.answer(d,d['consistency'])
+                self.reads.remove(r)
+                fut.set_result(None)
+        self.expire_reads(now)
+
+    def expire_reads(self,now):
+        # Give up on the reads whose deadline has passed, whatever they're waiting for
+        # (a lease, the leader's read index, or the log to catch up to it), so the CLI
+        # gets an error back instead of waiting forever.
+        for r in list(self.reads):
+            d,fut,deadline,_,i,_ = r
+            if now < deadline: continue
+            if i is None:
+                error = "Couldn't find out if the log is up to date, is the leader down?"
+            else:
+                error = "The log didn't catch up to slot {} in time.".format(i)
+            self.answer(d,d['consistency'],error=error)
+            self.reads.remove(r)
+            fut.set_result(None)
+        if not self.reads:
+            self.read_at = None
+            self.index_asked = {}
+
+    def rx_read_index(self,d):
+        # The leader's read index, for the reads that came in before we asked for it.
+        asked = self.index_asked.pop(d['id'],None)
+        if asked is None: return
+        for r in self.reads:
+            if r[4] is None and r[3] <= asked: r[4:] = [d['read index'],asked]
+        self.serve_reads()
+
+    def answer(self,d,level,error=None):
+        # Run query d and send the result back to the CLI that's waiting for it (see main()).
+        self.apply()
+        if error is not None:
+            r = {'error': error}
+        else:
+            cmd = d['cmd']
+            if cmd=='total':
+                r = self.total(d['logpositions'])
+            elif cmd=='merge':
+                r = self.merge(d['logpositions'],d.get('after'),d.get('limit',query.PAGE))
+            elif cmd=='count':
+                r = self.count(d['word'],d['logpositions'])
+            elif cmd=='top':
+                r = self.top(d['k'],d['logpositions'])
+            r = dict(r,applied=self.applied,consistency=level)  # (r may be cached, don't change it)
+            if level == 'bounded': r['age'] = time.time() - self.fresh_at
+        if 'reply' in d: d['reply'].set_result(codec.dumps(r))
 
 
     # END DATA QUERY CALLS
@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+# A discrete-event simulator for MultiPaxosNode (see PaxosNode.py), to see how the
+# protocol itself behaves without starting a single process or socket. Like
+# PaxosNode.py's main(), every node is a Python object and send() just hands msgs
+# to rx(), except that here each msg is delivered after a random delay (so msgs get
+# reordered), and may be dropped or duplicated. Nodes can be stopped and resumed
+# (a stopped node drops everything, like 'stop' at the CLI). Time is simulated, so a
+# run takes as long as the CPU work, and the same seed always gives the same run.
+#
+# 'proposers' of the nodes get values to put in the log (all at once, or as Poisson
+# arrivals at 'rate' per sec each) and, like the PRM, retry a value that isn't
+# decided within 'timeout': the leader re-runs Phase 1, a classic proposer proposes
+# it again. With more than one proposer they duel. For each cluster size we report
+#
+#   msgs/dec    msgs sent per decided slot
+#   rounds/dec  prepare and accept rounds (one proposer asking all acceptors) per decided slot
+#   dec/s       decided slots per simulated sec
+#   p50..max    latency from a value coming in to its proposer learning it was chosen, in ms
+#
+# and check that all nodes agree on every slot.
+#
+#   ./paxossim.py [--option=value ...]      e.g. ./paxossim.py --nodes=3,5 --drop=0.05 --proposers=2
+#
+# Options (and defaults) are in OPTIONS below; --json prints the results as JSON.
+
+import sys, heapq, random, json
+from PaxosNode import MultiPaxosNode
+
+OPTIONS = {
+    'nodes':      '3,5,7,9',  # cluster sizes to run
+    'mode':       'leader',   # 'leader' (stable leader) or 'classic' (Paxos per slot)
+    'window':     1,          # leader's values in flight at once
+    'proposers':  1,          # nodes that propose values
+    'values':     200,        # values to propose, in all
+    'rate':       0.0,        # values/sec per proposer; 0: all at once
+    'delay':      0.005,      # secs every msg takes
+    'jitter':     0.002,      # ... plus an exponentially distributed random delay with this mean
+    'drop':       0.0,        # chance a msg is lost
+    'dup':        0.0,        # chance a msg is delivered twice
+    'stop-every': 0.0,        # secs between stopping a random node; 0: never
+    'stop-for':   0.5,        # secs it stays stopped
+    'timeout':    0.05,       # secs before a proposer retries (randomly up to twice that, to break duels)
+    'until':      600.0,      # give up after this many simulated secs
+    'seed':       1,
+    }
+
+
+class Sim(object):
+    """
+    One run: n nodes, options o (see OPTIONS), random seed 'seed'.
+    """
+    def __init__(self,n,o,seed):
+        self.o = o
+        self.rng = random.Random(seed)
+        self.now = 0.0
+        self.events = []  # heap of (time, seq, what, args)
+        self.seq = 0
+
+        names = ['n{}'.format(i) for i in range(n)]
+        self.nodes = {}
+        for a in names:
+            mp = MultiPaxosNode(a,[b for b in names if b != a],lambda d,a=a: self.send(a,d),
+                                leader=o['mode']=='leader',window=o['window'],clock=lambda: self.now)
+            mp.decided = self.watch(a,mp.decided)
+            self.nodes[a] = mp
+        self.proposers = names[:o['proposers']]
+        self.stopped = set()
+
+        self.pending = {a:[] for a in names}    # a's values that a hasn't seen chosen yet, in order
+        self.retry_at = {a:None for a in names}
+        self.slot = {a:0 for a in names}        # a's first undecided slot, as of the last msg
+        self.submitted = {}                     # value -> when it came in
+        self.latency = []
+        self.first = {}                         # slot -> when someone first learned it was decided
+        self.sent = 0
+        self.rounds = set()                     # (proposer, type, slot, Num) for every round started
+
+    def at(self,t,what,*args):
+        self.seq += 1
+        heapq.heappush(self.events,(t,self.seq,what,args))
+
+    def watch(self,a,decided):
+        # Wrap node a's decided() so we hear about every slot it learns.
+        def f(i,v):
+            new = self.nodes[a].chosen(i) is None
+            decided(i,v)
+            if new: self.learned(a,i,v)
+        return f
+
+    ###########################################
+    # The network
+
+    def send(self,a,d):
+        if a in self.stopped: return  # (a stopped node still gets values to propose)
+        self.sent += 1
+        m = d.get('msg',d)
+        if m['type'] in ('multi prepare','prepare request'):
+            self.rounds.add((a,'prepare',d.get('elem'),m['n']))
+        elif m['type'] == 'accept request':
+            self.rounds.add((a,'accept',d.get('elem'),m['p'].n))
+        if self.rng.random() < self.o['drop']:
+            return
+        for _ in range(2 if self.rng.random() < self.o['dup'] else 1):
+            jitter = self.rng.expovariate(1/self.o['jitter']) if self.o['jitter'] else 0
+            self.at(self.now + self.o['delay'] + jitter,'deliver',d)
+
+    def deliver(self,d):
+        a = d['to']
+        if a in self.stopped: return
+        mp = self.nodes[a]
+        mp.rx(d)
+        if mp.first_undecided() != self.slot[a]:
+            # Like PaxosReplicator.check(): the log moved, so give our values a fresh timeout,
+            # and a classic proposer goes for the next slot.
+            self.slot[a] = mp.first_undecided()
+            if self.pending[a]:
+                self.retry(a,now=False)
+                if not mp.leader: mp.propose(self.pending[a][0])
+
+    ###########################################
+    # Proposers
+
+    def submit(self,a,v):
+        self.submitted[v] = self.now
+        self.pending[a].append(v)
+        if self.nodes[a].leader or len(self.pending[a]) == 1:
+            self.nodes[a].propose(v)
+        if self.retry_at[a] is None: self.retry(a,now=False)
+
+    def learned(self,a,i,v):
+        if i not in self.first: self.first[i] = self.now
+        if v in self.pending[a]:
+            self.pending[a].remove(v)
+            self.latency.append(self.now - self.submitted[v])
+            if not self.pending[a]: self.retry_at[a] = None
+
+    def retry(self,a,now=True):
+        # Retry a's values now (or just set the timer for it).
+        mp = self.nodes[a]
+        if now and self.pending[a]:
+            if mp.leader:
+                mp.retry()
+            else:
+                mp.propose(self.pending[a][0])
+        self.retry_at[a] = self.now + self.o['timeout']*(1 + self.rng.random())
+        self.at(self.retry_at[a],'timer',a)
+
+    def timer(self,a):
+        if self.retry_at[a] is None or self.now < self.retry_at[a] or a in self.stopped:
+            return  # an old timer, or nothing to do
+        self.retry(a)
+
+    ###########################################
+    # Failures
+
+    def stop(self):
+        # Stop a random node, as long as a majority stays up, and resume it later.
+        up = [a for a in sorted(self.nodes) if a not in self.stopped]
+        if len(self.stopped) + 1 < len(self.nodes)/2.0:
+            a = self.rng.choice(up)
+            self.stopped.add(a)
+            self.at(self.now + self.o['stop-for'],'resume',a)
+        self.at(self.now + self.o['stop-every'],'stop')
+
+    def resume(self,a):
+        self.stopped.discard(a)
+        if self.pending[a]: self.retry(a)
+
+    ###########################################
+
+    def run(self):
+        o = self.o
+        k = 0
+        for j,a in enumerate(self.proposers):
+            t = 0.0
+            for _ in range(o['values']//len(self.proposers) + (j < o['values'] % len(self.proposers))):
+                if o['rate']: t += self.rng.expovariate(o['rate'])
+                self.at(t,'submit',a,'{}:{}'.format(a,k))
+                k += 1
+        if o['stop-every']: self.at(o['stop-every'],'stop')
+        while self.events and len(self.latency) < k:
+            t,_,what,args = heapq.heappop(self.events)
+            if t > o['until']: break
+            self.now = t
+            getattr(self,what)(*args)
+        return self.stats()
+
+    def stats(self):
+        # Does everyone agree on every slot?
+        disagree = 0
+        for i in self.first:
+            vs = set(mp.chosen(i) for mp in self.nodes.values()) - {None}
+            if len(vs) > 1: disagree += 1
+        decided = len(self.first)
+        secs = max(self.first.values()) if self.first else 0
+        lat = sorted(self.latency)
+        def pct(q):
+            return 1000*lat[min(len(lat)-1,int(q*len(lat)))] if lat else None
+        return {
+            'nodes': len(self.nodes),
+            'decided': decided,
+            'unplaced': len(self.submitted) - len(self.latency),
+            'disagree': disagree,
+            'msgs/dec': self.sent/decided if decided else None,
+            'rounds/dec': len(self.rounds)/decided if decided else None,
+            'dec/s': decided/secs if secs else None,
+            'p50': pct(0.5), 'p90': pct(0.9), 'p99': pct(0.99), 'max': pct(1.0),
+            }
+
+
+def main():
+    o = dict(OPTIONS)
+    for a in sys.argv[1:]:
+        k,_,v = a[2:].partition('=')
+        if k == 'json': continue
+        if k not in o: sys.exit('Unknown option {}; options: {}'.format(a,', '.join(sorted(o))))
+        o[k] = type(o[k])(v)
+    results = [Sim(int(n),o,o['seed']).run() for n in str(o['nodes']).split(',')]
+    if '--json' in sys.argv[1:]:
+        print(json.dumps({'options':o,'results':results},indent=1))
+        return
+    print(' '.join('{}={}'.format(k,v) for k,v in sorted(o.items()) if k != 'nodes'))
+    cols = ['nodes','decided','unplaced','disagree','msgs/dec','rounds/dec','dec/s','p50','p90','p99','max']
+    print(' '.join('{:>10}'.format(c) for c in cols))
+    for r in results:
+        print(' '.join('{:>10}'.format('-' if r[c] is None else '{:.1f}'.format(r[c]) if isinstance(r[c],float) else r[c]) for c in cols))
+
+
+if __name__ == '__main__':
+    main()
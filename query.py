@@ -0,0 +1,184 @@
+import heapq
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+# Queries over the PRM's log, for the CLI.
+#
+# Each log entry is a LogValue (see paxosreplicator.py), which already is an index:
+# its total is precomputed and its words are sorted, with the counts in a parallel
+# array. So
+#
+#   total   sums the entries' totals                         O(positions)
+#   count   binary-searches each entry for the word          O(positions * log V)
+#   merge   k-way merges the entries' sorted words, a page   O(page * log positions)
+#           at a time, starting after the last word of the
+#           page before
+#   top     adds up everything and keeps the k biggest       O(V log k)
+#
+# Each query returns a dict that can go straight back to the CLI. merge returns at
+# most 'limit' (word,count) pairs, plus 'next': the word to pass as 'after' to get
+# the next page, or None if that was the last one.
+#
+# The PRM asks a Queries object, which remembers answers (see there), since the same
+# queries tend to come again and again.
+
+PAGE = 1000  # (word,count) pairs per page of a merge
+
+QUERIES = ('total','count','merge','top')  # CLI cmds that get their answer back
+
+CACHE_SIZE  = 256  # query results to remember
+RANGES_SIZE = 16   # merged ranges of the log to remember
+
+
+def total(vs):
+    return {'total': sum(v.total for v in vs)}
+
+
+def count(vs,word):
+    c = 0
+    for v in vs:
+        i = bisect_left(v.words,word)
+        if i < len(v.words) and v.words[i] == word: c += v.counts[i]
+    return {'word': word, 'count': c}
+
+
+def merged(vs,after=None):
+    # (word,count) for every word in LogValues vs, in word order, summed over vs;
+    # only the words after 'after' if that's given.
+    def items(v):
+        words,counts = v.words,v.counts
+        for i in range(bisect_right(words,after) if after is not None else 0,len(words)):
+            yield words[i],counts[i]
+    if len(vs) == 1:
+        yield from items(vs[0])
+        return
+    word,c = None,0
+    for w,n in heapq.merge(*[items(v) for v in vs]):
+        if w != word:
+            if word is not None: yield word,c
+            word,c = w,0
+        c += n
+    if word is not None: yield word,c
+
+
+def merge(vs,after=None,limit=PAGE):
+    page = []
+    for wc in merged(vs,after):
+        if len(page) == limit:
+            return {'words': page, 'next': page[-1][0]}
+        page.append(wc)
+    return {'words': page, 'next': None}
+
+
+def top(vs,k):
+    if len(vs) == 1:
+        wcs = zip(vs[0].words,vs[0].counts)
+    else:
+        wcs = added_up(vs).items()
+    return {'words': heapq.nlargest(k,wcs,key=lambda wc: wc[1])}
+
+
+def added_up(vs):
+    # {word: count} summed over vs. (Quicker than merged()'s heap when we need every word anyway.)
+    c = {}
+    get = c.get
+    for v in vs:
+        for w,n in zip(v.words,v.counts): c[w] = get(w,0) + n
+    return c
+
+
+class Sum(object):
+    """
+    Entries a..b-1 of the log added up, looking like one more LogValue:
+    sorted words, a parallel list of counts, and the total.
+    """
+    __slots__ = ('a','b','words','counts','total')
+
+    def __init__(self,a,b,vs):
+        c = added_up(vs)
+        self.a,self.b = a,b
+        self.words = sorted(c)
+        self.counts = [c[w] for w in self.words]
+        self.total = sum(v.total for v in vs)
+
+
+class Queries(object):
+    """
+    Answers queries over 'log' (a list of LogValues that only ever grows), and
+    remembers the answers in an LRU cache, keyed by the query and its positions
+    (sorted, each once). Entries never change once they're in the log, so an
+    answer only goes stale when an entry shows up at one of its positions that
+    wasn't there yet: the PRM calls added(i) when entry i does.
+
+    merge and top over a contiguous range of positions, e.g. 0 1 2 ... 99, work
+    off a Sum of the range instead, so each page of a merge is just a slice of it.
+    A Sum of a..c reuses the one of a..b (b<c) if we have it, so e.g. a dashboard
+    asking for everything so far only adds up the new entries each time.
+    """
+    def __init__(self,log):
+        self.log = log
+        self.results = OrderedDict()  # query key -> (answer, positions it needs that aren't in the log yet), LRU first
+        self.waiting = {}             # position not in the log yet -> keys of answers that depend on it
+        self.ranges = OrderedDict()   # (a,b) -> Sum of entries a..b-1
+        self.hits = self.misses = 0
+
+    def added(self,i):
+        # Entry i is in the log now.
+        for key in list(self.waiting.get(i,())):
+            self.forget(key)
+
+    def forget(self,key):
+        # Drop an answer, and every note that it waits for a position.
+        _,missing = self.results.pop(key)
+        for p in missing:
+            keys = self.waiting[p]
+            keys.discard(key)
+            if not keys: del self.waiting[p]
+
+    def total(self,positions):
+        return self.answer(('total',),positions,total)
+
+    def count(self,word,positions):
+        return self.answer(('count',word),positions,lambda vs: count(vs,word))
+
+    def merge(self,positions,after=None,limit=PAGE):
+        return self.answer(('merge',after,limit),positions,lambda vs: merge(vs,after,limit),ranged=True)
+
+    def top(self,k,positions):
+        return self.answer(('top',k),positions,lambda vs: top(vs,k),ranged=True)
+
+    def answer(self,query,positions,fn,ranged=False):
+        ps = tuple(sorted(set(p for p in positions if p >= 0)))
+        key = query + ps
+        if key in self.results:
+            self.hits += 1
+            self.results.move_to_end(key)
+            return self.results[key][0]
+        self.misses += 1
+        n = len(self.log)
+        have = [p for p in ps if p < n]
+        if ranged and len(have) > 1 and have[-1]-have[0] == len(have)-1:
+            vs = [self.range(have[0],have[-1]+1)]
+        else:
+            vs = [self.log[p] for p in have]
+        r = fn(vs)
+        missing = ps[len(have):]
+        self.results[key] = (r,missing)
+        for p in missing:
+            self.waiting.setdefault(p,set()).add(key)
+        if len(self.results) > CACHE_SIZE: self.forget(next(iter(self.results)))
+        return r
+
+    def range(self,a,b):
+        # The Sum of entries a..b-1, starting from the longest one we have of a..something before b.
+        s = self.ranges.get((a,b))
+        if s is None:
+            base = max((r for r in self.ranges.values() if r.a == a and r.b < b),key=lambda r: r.b,default=None)
+            if base is None:
+                s = Sum(a,b,self.log[a:b])
+            else:
+                s = Sum(a,b,[base]+self.log[base.b:b])
+            self.ranges[a,b] = s
+            if len(self.ranges) > RANGES_SIZE: self.ranges.popitem(last=False)
+        self.ranges.move_to_end((a,b))
+        return s
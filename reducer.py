@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
-import sys, json, pickle
+import sys, json, heapq, tempfile
 from collections import Counter
+from itertools import groupby
 from debug import debug
 import network
+import codec
+import intermediate
 import os
 
 
@@ -12,13 +15,13 @@ def main():
     network.worker(MY_ADDR,parser)
 
 def parser(b):
-    d = pickle.loads(b)
+    d = codec.loads(b)
     if 'cmd' in d and d['cmd']=='k': raise network.KillMe()
     filenames = d['filenames']
-    reduce(filenames)
+    reduce(filenames,d.get('format'),d.get('partition'),d.get('memory',0))
     return b'Done!'
 
-def reduce(fs):
+def reduce(fs,fmt=None,partition=None,memory=0):
     """
     A reduce receives a message consists of multiple
     intermediate filenames(e.g. f1_I_1,f1_I_2). Then it reads
@@ -31,24 +34,137 @@ def reduce(fs):
     output keys and their corresponding count to a file named
     {filename}_{reduced} where filename is the original input
     filename.
+
+    The intermediate files are read with intermediate.read(), in format
+    'fmt' if given, otherwise whatever format each file turns out to be in.
+
+    If this reducer handles one 'partition' p of a hash-partitioned
+    shuffle, the output goes to {filename}_reduced_{p} instead, and
+    concat() stitches the partitions together afterwards.
+
+    If 'memory' (MB) is nonzero, the reducer keeps to roughly that much
+    memory by doing an external merge instead; see reduce_external().
     """
     print("Reducing:",fs)
+    out = output_name(fs,partition)
+    if memory:
+        reduce_external(fs,fmt,out,memory*2**20)
+        print('Reduced to',out)
+        return
     counts = Counter()
     for f in fs:
         # The assignment says the mapper should simply lists the words:
         # [["It", 1], ["was", 1], ["a", 1], ["dark", 1], ... ]
-        # Therefore the reducer needs to tally these words.
-        # I think it would be more realistic if the mapper did some 
-        # actual work and then the reducer would aggregate the
-        # mappers' results.
-        words = [tup[0] for tup in json.load(open(f,'r'))]  # Turn to list of just words.
-        counts.update(Counter(words))
+        # but a combining mapper sends each word once with its count:
+        # [["It", 12], ["was", 40], ...]
+        # Summing the counts handles both.
+        for w,c in intermediate.iterate(f,fmt):
+            counts[w] += c
+    json.dump(counts,open(out,'w'))
+    print('Reduced to',out)
+
+
+def output_name(fs,partition=None):
     path,fname = os.path.split(fs[0])
     prefix = fname.split('_')[0]
     outname = prefix+'_reduced'
-    out = os.path.join(path,outname)
-    json.dump(counts,open(out,'w'))
-    print('Reduced to',out)
+    if partition is not None:
+        outname += '_{}'.format(partition)
+    return os.path.join(path,outname)
+
+
+ENTRY_BYTES = 120  # rough cost of one dict entry, on top of the word itself
+ITEM_BYTES = 64    # and of its (word,count) tuple in the list it's sorted into to spill
+FANIN = 16         # most runs we have open at once while merging
+
+def reduce_external(fs,fmt,out,budget):
+    """
+    Reduce with about 'budget' bytes of memory, however big the input.
+    'bin' intermediate files are already sorted runs, so they are streamed
+    straight into a k-way merge. Anything else is tallied in a dict that
+    gets spilled to a sorted temp file whenever it outgrows the budget.
+    The merged runs are summed word by word and written out as they go.
+    At most FANIN runs are merged at once: if there are more, they are
+    merged FANIN at a time into bigger runs first, so the open files and
+    their read buffers stay within the budget however many there are.
+    """
+    chunk = max(1<<12,min(1<<16,int(budget)//(2*FANIN)))  # each open run's read buffer
+    runs = []    # (iterator over a sorted run, its temp file or None)
+    spills = []  # temp files not removed yet
+    counts = {}
+    used = 0
+    path = os.path.dirname(out)
+    def temp():
+        fd,name = tempfile.mkstemp(prefix='.spill_',dir=path or '.')
+        os.close(fd)
+        spills.append(name)
+        return name
+    def spill():
+        name = temp()
+        intermediate.write_run(name,sorted(counts.items()),chunk=chunk)
+        debug('Spilled {} words to {}'.format(len(counts),name))
+        runs.append((intermediate.iterate(name,'bin',chunk),name))
+        counts.clear()
+    try:
+        for f in fs:
+            if (fmt or ('bin' if intermediate.is_binary(f) else 'json')) == 'bin':
+                runs.append((intermediate.iterate(f,'bin',chunk),None))
+                continue
+            for w,c in intermediate.iterate(f,fmt):
+                if w in counts:
+                    counts[w] += c
+                else:
+                    counts[w] = c
+                    used += len(w) + ENTRY_BYTES + ITEM_BYTES
+                    if used > budget:
+                        spill()
+                        used = 0
+        if counts: runs.append((iter(sorted(counts.items())),None))
+        while len(runs) > FANIN:
+            merging,runs = runs[:FANIN],runs[FANIN:]
+            name = temp()
+            intermediate.write_run(name,summed(heapq.merge(*[it for it,_ in merging])),chunk=chunk)
+            debug('Merged {} runs into {}'.format(len(merging),name))
+            for _,done in merging:
+                if done is not None:
+                    os.remove(done)
+                    spills.remove(done)
+            runs.append((intermediate.iterate(name,'bin',chunk),name))
+        with open(out,'w') as fd:
+            fd.write('{')
+            sep = ''
+            for w,c in summed(heapq.merge(*[it for it,_ in runs])):
+                fd.write('{}{}: {}'.format(sep,json.dumps(w),c))
+                sep = ', '
+            fd.write('}')
+    finally:
+        for name in spills: os.remove(name)
+
+
+def summed(pairs):
+    # Sorted (word,count) pairs with each word once, its counts added up.
+    for w,g in groupby(pairs,key=lambda p: p[0]):
+        yield w,sum(c for _,c in g)
+
+
+def concat(parts,out):
+    """
+    Stitch the reducers' outputs {filename}_reduced_{p} into one
+    {filename}_reduced. The partitions have disjoint keys, so each
+    JSON object can be spliced into the output as text without
+    parsing it.
+    """
+    with open(out,'w') as fd:
+        fd.write('{')
+        first = True
+        for part in parts:
+            body = open(part,'r').read().strip()[1:-1].strip()
+            if not body: continue
+            if not first: fd.write(', ')
+            fd.write(body)
+            first = False
+        fd.write('}')
+    print('Concatenated {} partitions to {}'.format(len(parts),out))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,144 @@
+import os, struct, zlib
+from debug import debug
+import codec
+
+# A write-ahead log with snapshots, for state that has to survive a crash.
+#
+# Records are appended with append(), which only buffers them. sync() writes
+# everything buffered so far and fsyncs once, so all the records from one go
+# round the caller's event loop share a single fsync (group commit). Nothing a
+# record describes should be acted on (e.g. told to another node) until the
+# sync() after it has returned.
+#
+# snapshot(state) writes the whole state to a new snapshot file and starts a
+# fresh WAL segment, so replay() only has to read the latest snapshot plus the
+# records appended since. Files in the directory:
+#
+#   snapshot    {'gen': g, 'state': ...}, replaced atomically by rename
+#   wal.<g>     records appended since snapshot g
+#
+# Each record (and the snapshot) is framed as length, crc32, codec bytes. A torn
+# or corrupt record at the end of the WAL (a crash in the middle of a write) is
+# dropped on replay, along with anything after it.
+
+FRAME = struct.Struct('!II')  # length, crc32
+
+class CorruptSnapshot(Exception): pass
+
+
+class WAL(object):
+    def __init__(self,dirname):
+        self.dir = dirname
+        os.makedirs(dirname,exist_ok=True)
+        self.gen = 0
+        self.f = None
+        self.buf = bytearray()
+        self.size = 0           # bytes in the current segment
+        self.snapshot_size = 0  # bytes in the last snapshot
+        self.syncs = 0
+
+    def path(self,name):
+        return os.path.join(self.dir,name)
+
+    def replay(self):
+        """
+        Read what's on disk. Returns (state from the latest snapshot or None,
+        [records appended since]), and opens the WAL for appending.
+        Call this once, before anything else.
+        """
+        state = None
+        try:
+            b = open(self.path('snapshot'),'rb').read()
+        except FileNotFoundError:
+            b = None
+        if b is not None:
+            d,_ = read_frame(b,0)
+            if d is None: raise CorruptSnapshot(self.path('snapshot'))
+            self.gen,state = d['gen'],d['state']
+            self.snapshot_size = len(b)
+        records = []
+        name = self.path('wal.{}'.format(self.gen))
+        if os.path.exists(name):
+            b = open(name,'rb').read()
+            i = 0
+            while i < len(b):
+                rec,j = read_frame(b,i)
+                if rec is None:
+                    print('WAL {}: dropping {} bytes of torn/corrupt records at the end'.format(name,len(b)-i))
+                    break
+                records.append(rec)
+                i = j
+            with open(name,'r+b') as f:
+                f.truncate(i)
+            self.f = open(name,'ab')
+        else:
+            self.f = open(name,'ab')
+            self.fsync_dir()  # a new segment's name has to survive a crash too, not just its records
+        self.size = self.f.tell()
+        self.remove_old()
+        debug('WAL {}: replayed snapshot {} and {} records'.format(self.dir,self.gen,len(records)))
+        return state,records
+
+    def append(self,rec):
+        b = codec.dumps(rec)
+        self.buf += FRAME.pack(len(b),zlib.crc32(b)) + b
+
+    def sync(self):
+        # Group commit: one write and one fsync for everything appended since the last sync().
+        if not self.buf: return
+        self.f.write(self.buf)
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.size += len(self.buf)
+        self.buf = bytearray()
+        self.syncs += 1
+
+    def want_snapshot(self,at_least=1<<20):
+        # Worth taking a snapshot once the WAL has outgrown the last one, so replay
+        # never reads much more than twice the state, and snapshots cost O(1) per byte logged.
+        return self.size > max(at_least,self.snapshot_size)
+
+    def snapshot(self,state):
+        self.sync()
+        gen = self.gen + 1
+        b = codec.dumps({'gen':gen,'state':state})
+        tmp = self.path('snapshot.tmp')
+        with open(tmp,'wb') as f:
+            f.write(FRAME.pack(len(b),zlib.crc32(b)) + b)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp,self.path('snapshot'))
+        self.f.close()
+        self.gen = gen
+        self.f = open(self.path('wal.{}'.format(gen)),'ab')
+        self.fsync_dir()  # for both the rename and the new segment
+        self.size = 0
+        self.snapshot_size = len(b) + FRAME.size
+        self.remove_old()
+        debug('WAL {}: snapshot {}, {} bytes'.format(self.dir,gen,self.snapshot_size))
+
+    def remove_old(self):
+        # WAL segments from before the current snapshot (left behind by a crash during snapshot()).
+        for name in os.listdir(self.dir):
+            if name.startswith('wal.') and name[4:].isdigit() and int(name[4:]) < self.gen:
+                os.remove(self.path(name))
+
+    def fsync_dir(self):
+        fd = os.open(self.dir,os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def read_frame(b,i):
+    # The object framed at b[i:], and where the next frame starts; (None,i) if it's torn or corrupt.
+    if i + FRAME.size > len(b): return None,i
+    n,crc = FRAME.unpack_from(b,i)
+    j = i + FRAME.size + n
+    if j > len(b) or zlib.crc32(b[i+FRAME.size:j]) != crc: return None,i
+    return codec.loads(b[i+FRAME.size:j]),j